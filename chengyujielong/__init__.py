@@ -19,7 +19,8 @@ else:
     config.__dict__.update(config_private.__dict__)
 
 from van import (
-    Fan, Status, FanfouError, Timeline
+    Fan, Status, FanfouError, Timeline, CircuitOpenError, MetricsCollector, AdaptivePoller,
+    StateJournal
 )
 
 log = logging.getLogger(__name__)
@@ -29,8 +30,11 @@ sess.mount('http://', HTTPAdapter(max_retries=5))
 fan = Fan(config.FAN_APP_KEY,
           config.FAN_APP_SECRET,
           config.FAN_ACCESS_TOKEN)
-state = {}
+metrics = MetricsCollector()
+fan.use(metrics)
+journal = None  # type: StateJournal
 new_day = False
+STAT_DAYS = 30  # 统计信息保留的天数
 emojis = ('😀😃😄😁🤣😂😅😆☺️😊😇🙂😍😌😉😘😗😬🙄😵'
           '😛😋😝😜🐶🐱🐭🐹🐼🐻🦊🐰🐨🐯🦁🐮🐷🐽🐸🐵'
           '🍏🍎🍐🍊🍋🍌🍉🍇🍅🥝🥥🍍🍑🍒🍈🍓🍆🥑🥦🥒'
@@ -48,42 +52,33 @@ def new_token():
     print(token)
 
 
-def restore_state():
-    global state
-    with open('state.json', encoding='utf-8') as f:
-        log.info('Restoring state from state.json')
-        state = json.load(f)
-
-
-def save_state():
-    with open('state.json', 'wt', encoding='utf-8') as f:
-        log.info('Dumping state to state.json')
-        json.dump(state, f, indent=2, ensure_ascii=False, sort_keys=True)
-
-
 def today_statistics():
-    """记录统计信息"""
+    """记录统计信息，返回今天的日期"""
     global new_day
 
     today = date.today().isoformat()
-    stat = state['stat']
-    try:
-        today_stat = stat[today]
-    except KeyError:
+    if journal.get(('stat', today)) is None:
         # 标记新的一天开始
         new_day = True
-        today_stat = {}
+        journal.set(('stat', today), {})
+        prune_statistics()
+    return today
+
 
-    stat[today] = Counter(today_stat)
-    return stat[today]
+def prune_statistics(days=STAT_DAYS):
+    """只保留最近几天的统计信息"""
+    oldest = (date.today() - timedelta(days=days)).isoformat()
+    for day in list(journal.get('stat', {})):
+        if day < oldest:
+            journal.delete(('stat', day))
 
 
 def conclude_yesterday():
     yesterday = (date.today() - timedelta(days=1)).isoformat()
-    try:
-        stat = Counter(state['stat'][yesterday])
-    except KeyError as e:
+    stat = journal.get(('stat', yesterday))
+    if stat is None:
         return None
+    stat = Counter(stat)
 
     user_cnt = len(stat.keys())
     mention_cnt = sum(stat.values())
@@ -149,28 +144,34 @@ def reply(status: Status):
             time.sleep(1)
 
 
-def get_message(since_id=None):
+def get_message():
     global new_day
 
-    mentions = Timeline(fan, None, 'statuses/mentions', max_id=since_id)
-    idle = 1
+    # 游标由 Timeline 记录在 journal 中，mention_since_id 是旧版本保存的位置
+    since_id = journal.get('mention_since_id')
+    mentions = Timeline(fan, None, 'statuses/mentions', max_id=since_id, max_backfill=5,
+                        journal=journal, journal_key='mentions')
+    if since_id is not None:
+        # 先写入新的位置再删除旧的，中间退出也不会丢失游标
+        mentions.checkpoint()
+        journal.delete('mention_since_id')
+    poller = AdaptivePoller(mentions, target_latency=2, metrics=metrics)
     while True:
         try:
-            statuses = mentions.fetch_newer()
+            statuses = poller.poll()
+        except CircuitOpenError as e:
+            log.warning('Fanfou seems down, wait %.1f seconds', e.retry_after)
+            time.sleep(e.retry_after)
+            continue
         except FanfouError as e:
             # Fanfou 有可能宕机了
             log.exception('Fetch new mentions error')
             time.sleep(3)
+            continue
 
         log.info('Got %s new mentions', len(statuses))
-        if not statuses:
-            idle = min(idle * 1.5, 60)
-        elif len(statuses) <= 3:
-            idle = 3
-        else:
-            idle = 1
-
-        stat = today_statistics()
+
+        today = today_statistics()
         if new_day:
             conclusion = conclude_yesterday()
             if conclusion:
@@ -186,24 +187,23 @@ def get_message(since_id=None):
             if st.user.id == fan.me.id:
                 log.info('Ignore one mention by self')
                 continue
-            stat.update([st.user.screen_name])
+            journal.incr(('stat', today, st.user.screen_name))
             yield st
 
-        state['mention_since_id'] = mentions._max_id
-        save_state()
-        log.info('Falling sleep for %s seconds', idle)
-        time.sleep(idle)
+        log.info('Falling sleep for %.1f seconds', poller.interval)
+        poller.wait()
 
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
-    atexit.register(save_state)
+    journal = StateJournal('state.json')
+    atexit.register(journal.close)
+    atexit.register(metrics.log_summary)
+    metrics.start_logging(600)
 
     while True:
         try:
-            restore_state()
-            since_id = state['mention_since_id']
-            for message in get_message(since_id):
+            for message in get_message():
                 reply(message)
         except Exception as e:
             log.exception('Something bad happened')
@@ -3,48 +3,1178 @@
 
 from __future__ import print_function, unicode_literals, absolute_import
 
+import asyncio
+import codecs
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import logging
+import math
+import os
+import queue
+import random
 import re
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
 
-import arrow
 import requests
+from oauthlib.oauth1 import Client as OAuth1Client
 from requests.adapters import HTTPAdapter
 from requests_oauthlib.oauth1_session import OAuth1Session
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+    _aiohttp_connect_timeout = ()
+else:
+    # aiohttp 3.10 之前连接超时没有单独的异常类型
+    _aiohttp_connect_timeout = getattr(aiohttp, 'ConnectionTimeoutError', ())
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 log = logging.getLogger(__name__)
 
+WRITE_ENDPOINTS = ('statuses/update', 'photos/upload')
+"""发消息的 API，与读取类 API 分开限流"""
+
+RATE_LIMIT_MESSAGES = ('rate limit', '频率', '超过限制', '次数过多')
+
+WALK_PREFETCH = 1
+"""遍历关注者/好友列表时预取的页数，这些列表通常有很多页并且会被完整遍历"""
+
+DEFAULT_CACHE_TTL = {
+    'users/show': 300,
+    'statuses/show': 600,
+    'friendships/show': 60,
+    'blocks/exists': 60,
+}
+"""可以缓存的 API 及其缓存秒数"""
+
+CACHE_INVALIDATION = {
+    'statuses/update': ('users/show',),
+    'photos/upload': ('users/show',),
+    'statuses/destroy': ('statuses/show', 'users/show'),
+    'favorites/create': ('statuses/show',),
+    'favorites/destroy': ('statuses/show',),
+    'friendships/create': ('friendships/show', 'users/show'),
+    'friendships/destroy': ('friendships/show', 'users/show'),
+    'friendships/deny': ('friendships/show',),
+    'blocks/create': ('blocks/exists', 'friendships/show', 'users/show'),
+    'blocks/destroy': ('blocks/exists', 'friendships/show', 'users/show'),
+}
+"""POST 请求成功后需要失效的缓存，未列出的 POST 请求会清空整个缓存"""
+
+
+def pager(fan, endpoint, prefetch=None, **params):
+    """
+    用 page 参数逐页获取，逐条产出结果，遇到空页时结束。
+
+    调用方处理当前页时，后面 `prefetch` 页已经在后台线程中获取；提前停止迭代时取消还没开始的请求，
+    已经发出的请求会被丢弃。第一页为空时不预取。
 
-def pager(fan, endpoint, **params):
-    page = 1
-    while True:
-        _, rv = fan.get(endpoint, page=page, **params)
-        if _:
+    :param int prefetch: 预取的页数，默认为 ``fan.pager_prefetch``，为 0 时不预取
+    """
+    if prefetch is None:
+        prefetch = getattr(fan, 'pager_prefetch', 0)
+    fetch = functools.partial(fan.get, endpoint, **params)
+    pages = itertools.count(1)
+    pending = deque()
+    executor = None
+    if prefetch:
+        executor = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='pager-prefetch')
+    try:
+        while True:
+            rv = pending.popleft().result() if pending else fetch(page=next(pages))
+            if not rv:
+                return
+            while executor is not None and len(pending) < prefetch:
+                pending.append(executor.submit(fetch, page=next(pages)))
+            for r in rv:
+                yield r
+    finally:
+        for future in pending:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+async def async_pager(fan, endpoint, prefetch=None, **params):
+    """:func:`pager` 的异步版本，配合 :class:`AsyncFan` 使用，预取的页用 Task 并发获取"""
+    if prefetch is None:
+        prefetch = getattr(fan, 'pager_prefetch', 0)
+    pages = itertools.count(1)
+    pending = deque()
+    try:
+        while True:
+            rv = await (pending.popleft() if pending else fan.get(endpoint, page=next(pages), **params))
             if not rv:
                 return
+            while len(pending) < prefetch:
+                pending.append(asyncio.ensure_future(fan.get(endpoint, page=next(pages), **params)))
             for r in rv:
                 yield r
-            page += 1
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+_MONTHS = {name: i for i, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+
+@functools.lru_cache(maxsize=64)
+def _utc_offset(offset):
+    return timezone(timedelta(seconds=offset)) if offset else timezone.utc
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_created_at(value):
+    """
+    解析饭否的时间格式 ``Sat Oct 20 05:50:44 +0000 2018``，返回带时区的 datetime。
+    同一时间字符串只解析一次。
+    """
+    # 0         1         2
+    # 012345678901234567890123456789
+    # Sat Oct 20 05:50:44 +0000 2018
+    try:
+        if len(value) != 30 or value[20] not in '+-':
+            raise ValueError
+        offset = int(value[21:23]) * 3600 + int(value[23:25]) * 60
+        if value[20] == '-':
+            offset = -offset
+        return datetime(int(value[26:30]), _MONTHS[value[4:7]], int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                        tzinfo=_utc_offset(offset))
+    except (ValueError, KeyError):
+        return datetime.strptime(value, '%a %b %d %H:%M:%S %z %Y')
+
+
+def _strip_none(params):
+    """去掉值为 None 的参数，与 requests 的行为保持一致"""
+    return [(k, v) for k, v in (params or {}).items() if v is not None]
+
+
+def _check_response(status_code, json_data):
+    """检查 API 返回结果，出错时抛出 :class:`ApiRequestError`"""
+    if status_code == 200:
+        return json_data
+    error = json_data.get('error') if isinstance(json_data, dict) else None
+    if status_code == 429 or (error and any(m in error.lower() for m in RATE_LIMIT_MESSAGES)):
+        raise RateLimitError(error or 'Rate limit exceeded')
+    if error:
+        raise ApiRequestError(error)
+    raise ApiRequestError('Invalid error response')
+
+
+class _DedupeResults(OrderedDict):
+    """记录最近成功的 dedupe_key 及其结果，只保留最近 ``maxsize`` 个"""
+
+    def __init__(self, maxsize=1024):
+        super().__init__()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            if len(self) > self.maxsize:
+                self.popitem(last=False)
+
+    def lookup(self, key):
+        """在锁内一次完成查找，返回 (是否存在, 结果)，先判断再读取的话中间可能被淘汰"""
+        with self._lock:
+            if key in self:
+                return True, super().__getitem__(key)
+            return False, None
+
+
+def default_json_loads():
+    """返回可用的最快的 JSON 解析函数：orjson，ujson，最后是标准库"""
+    if orjson is not None:
+        return orjson.loads
+    if ujson is not None:
+        return ujson.loads
+    return json.loads
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DELIMITERS = frozenset(' \t\n\r,]')
+
+
+def iter_json_array(chunks):
+    """
+    从字节块中增量解析 JSON 数组，每解析出一个元素就产出一个，不必等整个数组接收完。
+    数据不是合法的 JSON 数组时抛出 ValueError。
+
+    :param chunks: 产出 bytes 的可迭代对象
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    raw_decode = json.JSONDecoder().raw_decode
+    buf = ''
+    pos = 0
+    # 0: 等待 '['，1: 等待第一个元素或 ']'，2: 等待 ',' 或 ']'，3: 等待元素，4: 数组已结束
+    state = 0
+    chunks = iter(chunks)
+    eof = False
+    while not eof:
+        chunk = next(chunks, None)
+        eof = chunk is None
+        buf = buf[pos:] + decoder.decode(chunk or b'', final=eof)
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            c = buf[pos]
+            if state == 0:
+                if c != '[':
+                    raise ValueError('Expecting JSON array')
+                state = 1
+                pos += 1
+            elif state in (1, 2) and c == ']':
+                state = 4
+                pos += 1
+            elif state == 2:
+                if c != ',':
+                    raise ValueError("Expecting ',' delimiter at {}".format(pos))
+                state = 3
+                pos += 1
+            elif state == 4:
+                raise ValueError('Extra data')
+            else:
+                try:
+                    item, end = raw_decode(buf, pos)
+                except ValueError:
+                    # 元素还没接收完
+                    if eof:
+                        raise
+                    break
+                if not eof and (end == len(buf) or buf[end] not in _DELIMITERS):
+                    # 末尾的数字可能还没接收完，例如 "1.5e" 后面还有 "10"
+                    break
+                yield item
+                state = 2
+                pos = end
+    if state != 4:
+        raise ValueError('Unterminated JSON array')
+
+
+def _group_missing(objs, attrs=None):
+    """找出缺少属性的对象，按 (endpoint, id) 分组"""
+    pending = OrderedDict()
+    for obj in objs:
+        if obj is None:
+            continue
+        if all(attr in obj.dict for attr in attrs or obj.attrs):
+            continue
+        pending.setdefault((obj.endpiont, obj.dict.get('id')), []).append(obj)
+    return pending
+
+
+def endpoint_name(endpoint):
+    """去掉路径中的 id，favorites/create/:id 这类 API 返回 favorites/create"""
+    return '/'.join(endpoint.split('/', 2)[:2])
+
+
+def endpoint_class(endpoint):
+    """返回 API 所属的限流类别：'write' 或 'read'"""
+    return 'write' if endpoint in WRITE_ENDPOINTS else 'read'
+
+
+def default_rate_limiters():
+    """
+    默认的限流器：读取类 API 按饭否每小时 1500 次的限制，发消息单独限流
+    """
+    return {
+        'read': RateLimiter(1500 / 3600, burst=60),
+        'write': RateLimiter(1 / 3, burst=5),
+    }
+
+
+class RateLimiter:
+    """
+    线程安全的令牌桶限流器。
+
+    请求前调用 :meth:`acquire` 等待令牌，令牌不足时调用方会被阻塞而不是收到错误。
+    服务器返回频率限制错误时调用 :meth:`penalize` 把速率减半，之后每次成功请求 :meth:`reward` 逐步恢复。
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None, recovery=1.05):
+        """
+        :param float rate: 每秒产生的令牌数
+        :param int burst: 令牌桶容量，即允许的突发请求数
+        :param float min_rate: 被惩罚后速率的下限，默认为 rate 的 1/16
+        :param float recovery: 每次成功请求后速率恢复的倍数
+        """
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = min_rate or self.rate / 16
+        self.burst = burst
+        self.recovery = recovery
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.acquired = 0
+        self.waits = 0
+        self.waited = 0.0  # 调用方累计等待的秒数
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens=1, max_wait=None):
+        """
+        预订令牌，返回调用方需要等待的秒数。
+        令牌不够时允许“透支”，后来的调用方会排在后面等待更久。
+
+        :param float max_wait: 需要等待的时间超过此值时不预订，返回 None
+        """
+        with self._lock:
+            self._refill()
+            delay = max(0.0, (tokens - self._tokens) / self.rate)
+            if max_wait is not None and delay > max_wait:
+                return None
+            self._tokens -= tokens
+            self.acquired += 1
+            if delay:
+                self.waits += 1
+                self.waited += delay
+            return delay
+
+    def acquire(self, tokens=1):
+        """阻塞直到获得令牌，返回等待的秒数"""
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def penalize(self):
+        """收到频率限制错误：速率减半并清空令牌桶"""
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+        log.warning('Rate limited by server, slow down to %.3f requests/s', self.rate)
+
+    def reward(self):
+        """请求成功，逐步恢复速率"""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate * self.recovery)
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'acquired': self.acquired,
+            'waits': self.waits,
+            'waited': self.waited,
+        }
+
+
+class ResponseCache:
+    """
+    读取类 API 的响应缓存。
+
+    以 API 和规范化后的参数为键，每个 API 单独设置过期时间，超过容量后淘汰最久未使用的条目。
+    缓存的结果会直接返回给调用方，调用方不应修改。
+    """
+
+    def __init__(self, ttl=None, maxsize=1024):
+        """
+        :param dict ttl: API 到缓存秒数的映射，只有其中的 API 会被缓存，默认为 :data:`DEFAULT_CACHE_TTL`
+        :param int maxsize: 最多缓存的条目数
+        """
+        self.ttl = dict(DEFAULT_CACHE_TTL if ttl is None else ttl)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(endpoint, params):
+        return endpoint, tuple(sorted((k, str(v)) for k, v in params.items() if v is not None))
+
+    def get(self, key):
+        """返回缓存的结果，没有命中时返回 None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        ttl = self.ttl.get(key[0])
+        if not ttl:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *endpoints):
+        """删除指定 API 的全部缓存，不指定时清空缓存"""
+        with self._lock:
+            if not endpoints:
+                self._data.clear()
+                return
+            for key in [k for k in self._data if k[0] in endpoints]:
+                del self._data[key]
+
+    def invalidate_after(self, endpoint):
+        """POST 请求之后失效受影响的缓存"""
+        endpoint = endpoint_name(endpoint)
+        self.invalidate(*CACHE_INVALIDATION.get(endpoint, ()))
+        if endpoint not in CACHE_INVALIDATION:
+            self.invalidate()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+        }
+
+
+class SingleFlight:
+    """
+    合并并发的相同请求：同一个键同时只有一个请求在进行，其他调用方等待并共享它的结果或异常。
+    """
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0  # 真正发出的请求数
+        self.collapsed = 0  # 被合并掉的请求数
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.calls += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'collapsed': self.collapsed,
+        }
+
+
+class IdentityMap:
+    """
+    按 id 保存对象的弱引用，同一个 id 始终对应同一个对象。
+    对象不再被其他地方引用时自动从表中移除，占用的内存随存活对象的数量而定。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._objects)
+
+    def get(self, id):
+        return self._objects.get(id)
+
+    def merge(self, id, data, factory):
+        """
+        返回 id 对应的已有对象，并用 data 中的字段更新它；没有则用 factory() 创建并记录
+
+        :param id: 对象的 id
+        :param dict data: 新获取到的数据
+        :param factory: 创建新对象的函数
+        """
+        with self._lock:
+            obj = self._objects.get(id)
+            if obj is None:
+                self.misses += 1
+                obj = self._objects[id] = factory()
+            else:
+                self.hits += 1
+                if obj.dict is not data:
+                    obj.dict.update(data)
+            return obj
+
+    def stats(self):
+        return {
+            'size': len(self._objects),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SeenIds:
+    """
+    最近出现过的 maxsize 个 id 的精确集合，超出后淘汰最久没有出现的
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+
+    def __contains__(self, item):
+        return item in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, item):
+        """加入一个 id，返回它之前是否没有出现过"""
+        if item in self._ids:
+            self._ids.move_to_end(item)
+            return False
+        self._ids[item] = None
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+        return True
+
+
+class BloomFilter:
+    """
+    判断一个 id 是否出现过的 Bloom 过滤器，可能把没出现过的误判为出现过，但不会漏判。
+
+    分新旧两代，当前一代加入 capacity 个元素后丢弃旧的一代、新建一代，
+    因此总能记住最近 capacity 到 2 * capacity 个元素，占用的内存固定。
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        """
+        :param int capacity: 每一代的容量
+        :param float error_rate: 一代装满时的误判率，同时查询新旧两代，总的误判率最多约为它的两倍
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.bits / capacity * math.log(2)), 1)
+        self._current = bytearray((self.bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._count = 0  # 当前一代的元素数
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    @staticmethod
+    def _test(array, positions):
+        return all(array[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def __contains__(self, item):
+        positions = self._positions(item)
+        return self._test(self._current, positions) or self._test(self._previous, positions)
+
+    def add(self, item):
+        """加入一个 id，返回它之前是否（可能）没有出现过"""
+        positions = self._positions(item)
+        if self._test(self._current, positions) or self._test(self._previous, positions):
+            return False
+        if self._count >= self.capacity:
+            self._previous = self._current
+            self._current = bytearray(len(self._previous))
+            self._count = 0
+        for p in positions:
+            self._current[p >> 3] |= 1 << (p & 7)
+        self._count += 1
+        return True
+
+
+class SeenFilter:
+    """
+    时间线去重：最近的 id 用 :class:`SeenIds` 精确判断，更早的用可选的 :class:`BloomFilter` 判断。
+    查询和加入都是 O(1)，占用的内存固定。
+
+    作为 :class:`Timeline` 的 `dedup` 参数使用，任何实现了 ``in`` 和 ``add(id) -> bool`` 的对象都可以代替它。
+    """
+
+    def __init__(self, maxsize=10000, bloom_capacity=None, error_rate=0.001):
+        """
+        :param int maxsize: 精确记住的 id 数
+        :param int bloom_capacity: Bloom 过滤器每一代的容量，为 None 时不使用
+        :param float error_rate: Bloom 过滤器的误判率，误判的新消息会被当作重复丢弃
+        """
+        self.recent = SeenIds(maxsize)
+        self.bloom = BloomFilter(bloom_capacity, error_rate) if bloom_capacity else None
+        self.added = 0
+        self.duplicates = 0
+
+    def __contains__(self, item):
+        return item in self.recent or (self.bloom is not None and item in self.bloom)
+
+    def add(self, item):
+        """加入一个 id，返回它之前是否没有出现过"""
+        new = self.recent.add(item)
+        if self.bloom is not None:
+            new = self.bloom.add(item) and new
+        if new:
+            self.added += 1
         else:
+            self.duplicates += 1
+        return new
+
+    def stats(self):
+        return {
+            'recent': len(self.recent),
+            'added': self.added,
+            'duplicates': self.duplicates,
+        }
+
+
+class StateJournal:
+    """
+    小型的持久化状态存储：一个 JSON 快照文件，加上一个只追加的日志文件 ``path + '.journal'``。
+
+    :meth:`set`/:meth:`incr`/:meth:`delete` 只在日志末尾追加一行，写入量与改动的大小成正比。
+    日志达到 `compact_after` 条时把全部状态写成新的快照：先写临时文件并 fsync，再用 os.replace 原子地替换，
+    最后清空日志。打开时读取快照再重放日志，崩溃时写了一半的最后一行会被丢弃。
+
+    键可以是字符串，也可以是表示嵌套路径的元组，例如 ``('stat', '2018-10-14', 'user')``。
+    快照就是普通的 JSON 文件，可以直接打开以前用 json.dump 保存的状态文件。
+    """
+    _SEQ_KEY = '__journal_seq__'  # 快照中记录已包含的日志序号
+
+    def __init__(self, path, compact_after=1000, fsync=False):
+        """
+        :param str path: 快照文件的路径
+        :param int compact_after: 日志达到多少条时压缩
+        :param bool fsync: 每次追加日志后是否 fsync，否则只 flush，进程崩溃不会丢数据，系统崩溃可能会
+        """
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.compact_after = compact_after
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._state = {}
+        self._seq = 0
+        self._load()
+        self._entries = self._replay()
+        self._fp = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self._state = json.load(f)
+        except FileNotFoundError:
             return
+        self._seq = self._state.pop(self._SEQ_KEY, 0)
 
+    def _replay(self):
+        """重放日志中比快照新的记录，返回日志的条数"""
+        entries = good = 0
+        try:
+            f = open(self.journal_path, 'rb')
+        except FileNotFoundError:
+            return 0
+        with f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete line')
+                    seq, op, key, value = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    log.warning('Discard broken entry at the end of %s', self.journal_path)
+                    break
+                good += len(line)
+                entries += 1
+                if seq > self._seq:
+                    self._apply(op, key, value)
+                    self._seq = seq
+            size = f.seek(0, os.SEEK_END)
+        if good < size:
+            os.truncate(self.journal_path, good)
+        return entries
+
+    def _apply(self, op, key, value):
+        keys = [key] if isinstance(key, str) else list(key)
+        node = self._state
+        for k in keys[:-1]:
+            node = node.setdefault(k, {})
+        last = keys[-1]
+        if op == 'set':
+            node[last] = value
+        elif op == 'incr':
+            node[last] = node.get(last, 0) + value
+        elif op == 'delete':
+            node.pop(last, None)
+        else:
+            raise ValueError('Unknown journal operation {!r}'.format(op))
+
+    def _append(self, op, key, value=None):
+        with self._lock:
+            self._apply(op, key, value)
+            self._seq += 1
+            self._fp.write(json.dumps([self._seq, op, key, value], ensure_ascii=False) + '\n')
+            self._fp.flush()
+            if self.fsync:
+                os.fsync(self._fp.fileno())
+            self._entries += 1
+            if self._entries >= self.compact_after:
+                self.compact()
+
+    def get(self, key, default=None):
+        """读取一个值。返回的 dict/list 不要直接修改，修改不会写入日志"""
+        keys = [key] if isinstance(key, str) else list(key)
+        node = self._state
+        with self._lock:
+            for k in keys:
+                if not isinstance(node, dict) or k not in node:
+                    return default
+                node = node[k]
+        return node
+
+    def set(self, key, value):
+        """设置一个值，value 需要能被 JSON 序列化"""
+        self._append('set', key, value)
+
+    def incr(self, key, amount=1):
+        """把一个数值加上 amount，不存在时从 0 开始"""
+        self._append('incr', key, amount)
+
+    def delete(self, key):
+        self._append('delete', key)
+
+    def compact(self):
+        """把全部状态写成新的快照，然后清空日志"""
+        with self._lock:
+            data = dict(self._state)
+            data[self._SEQ_KEY] = self._seq
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2, ensure_ascii=False, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            # 在这之前崩溃的话，重放时会跳过快照中已经包含的记录
+            self._fp.close()
+            self._fp = open(self.journal_path, 'w', encoding='utf-8')
+            self._entries = 0
+
+    def close(self):
+        """压缩并关闭日志"""
+        with self._lock:
+            if self._fp.closed:
+                return
+            self.compact()
+            self._fp.close()
+
+    def __enter__(self):
+        return self
 
-class cached_property(object):
-    """ A property that is only computed once per instance and then replaces
-        itself with an ordinary attribute. Deleting the attribute resets the
-        property.
+    def __exit__(self, *exc):
+        self.close()
 
-        Source: https://github.com/bottlepy/bottle/commit/fa7733e075da0d790d809aa3d2f53071897e6f76
+
+class RequestContext:
+    """
+    一次 HTTP 请求的信息，在 :meth:`Fan.use` 注册的中间件之间传递。
+    请求完成后会填入 ``status_code`` 和 ``response_size``。
+    """
+
+    def __init__(self, method, endpoint, url, kwargs):
+        self.method = method
+        self.endpoint = endpoint
+        self.url = url
+        self.kwargs = kwargs  # 传给 requests 的参数
+        self.status_code = None
+        self.response_size = None
+
+
+def _prometheus_labels(pairs):
+    """格式化 Prometheus 标签，按文本格式的要求转义值中的反斜杠、双引号和换行"""
+    return ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs)
+
+
+class MetricsCollector:
+    """
+    请求指标收集器，作为中间件注册到 :class:`Fan` 上::
+
+        metrics = MetricsCollector()
+        fan.use(metrics)
+
+    按 API 记录延迟分布、响应大小、状态码和异常类型，也可以用 :meth:`set_gauge` 记录其他组件的状态。
+    可以输出 Prometheus 文本格式，或者通过 :meth:`start_logging` 定期把摘要写到日志里。
+    """
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix='van'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._latency = defaultdict(lambda: [0] * (len(self.buckets) + 1))  # (endpoint, method) -> 各区间计数
+        self._latency_sum = defaultdict(float)
+        self._bytes = defaultdict(int)
+        self._codes = defaultdict(int)  # (endpoint, status_code)
+        self._errors = defaultdict(int)  # (endpoint, exception)
+        self._gauges = {}  # (name, labels) -> value
+        self._timer = None
+        self._timer_lock = threading.Lock()
+
+    def __call__(self, handler):
+        def middleware(ctx):
+            start = time.monotonic()
+            error = None
+            try:
+                return handler(ctx)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                self.observe(ctx.endpoint, ctx.method, time.monotonic() - start,
+                             ctx.status_code, ctx.response_size, error)
+        return middleware
+
+    def observe(self, endpoint, method, elapsed, status_code=None, size=None, error=None):
+        """记录一次请求"""
+        endpoint = endpoint_name(endpoint)
+        key = (endpoint, method)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if elapsed <= bound:
+                index = i
+                break
+        with self._lock:
+            self._latency[key][index] += 1
+            self._latency_sum[key] += elapsed
+            if size is not None:
+                self._bytes[endpoint] += size
+            if status_code is not None:
+                self._codes[(endpoint, status_code)] += 1
+            if error is not None:
+                self._errors[(endpoint, error)] += 1
+
+    def set_gauge(self, name, value, **labels):
+        """
+        记录一个可增可减的数值，例如轮询间隔
+
+        :param str name: 指标名，输出时加上 prefix
+        :param value: 当前值
+        :param labels: 标签
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render_prometheus(self):
+        """以 Prometheus 文本格式输出所有指标"""
+        name = self.prefix + '_request_duration_seconds'
+        lines = ['# HELP {} Fanfou API request latency.'.format(name),
+                 '# TYPE {} histogram'.format(name)]
+        with self._lock:
+            for (endpoint, method), counts in sorted(self._latency.items()):
+                labels = _prometheus_labels((('endpoint', endpoint), ('method', method)))
+                total = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    total += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, total))
+                lines.append('{}_sum{{{}}} {}'.format(name, labels, self._latency_sum[(endpoint, method)]))
+                lines.append('{}_count{{{}}} {}'.format(name, labels, total))
+
+            name = self.prefix + '_response_bytes_total'
+            lines += ['# HELP {} Fanfou API response body size.'.format(name),
+                      '# TYPE {} counter'.format(name)]
+            for endpoint, size in sorted(self._bytes.items()):
+                lines.append('{}{{{}}} {}'.format(name, _prometheus_labels((('endpoint', endpoint),)), size))
+
+            name = self.prefix + '_responses_total'
+            lines += ['# HELP {} Fanfou API responses by status code.'.format(name),
+                      '# TYPE {} counter'.format(name)]
+            for (endpoint, code), count in sorted(self._codes.items()):
+                labels = _prometheus_labels((('endpoint', endpoint), ('code', code)))
+                lines.append('{}{{{}}} {}'.format(name, labels, count))
+
+            name = self.prefix + '_request_errors_total'
+            lines += ['# HELP {} Fanfou API request errors by exception type.'.format(name),
+                      '# TYPE {} counter'.format(name)]
+            for (endpoint, error), count in sorted(self._errors.items()):
+                labels = _prometheus_labels((('endpoint', endpoint), ('exception', error)))
+                lines.append('{}{{{}}} {}'.format(name, labels, count))
+
+            typed = set()
+            for (gauge, labels), value in sorted(self._gauges.items()):
+                name = '{}_{}'.format(self.prefix, gauge)
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{}{{{}}} {}'.format(name, _prometheus_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """每个 API 一行的摘要：请求数、错误率、平均延迟和响应大小"""
+        lines = []
+        with self._lock:
+            totals = defaultdict(lambda: [0, 0.0])
+            for (endpoint, _), counts in self._latency.items():
+                totals[endpoint][0] += sum(counts)
+            for (endpoint, method), elapsed in self._latency_sum.items():
+                totals[endpoint][1] += elapsed
+            errors = defaultdict(int)
+            for (endpoint, _), count in self._errors.items():
+                errors[endpoint] += count
+            for endpoint, (count, elapsed) in sorted(totals.items()):
+                lines.append('{}: {} requests, {:.1%} errors, {:.3f}s avg, {} bytes'.format(
+                    endpoint, count, errors[endpoint] / count, elapsed / count, self._bytes[endpoint]))
+            for (gauge, labels), value in sorted(self._gauges.items()):
+                labels = ','.join('{}={}'.format(k, v) for k, v in labels)
+                lines.append('{}[{}]: {:g}'.format(gauge, labels, value))
+        return '\n'.join(lines)
+
+    def log_summary(self):
+        summary = self.summary()
+        if summary:
+            log.info('Fanfou API metrics:\n%s', summary)
+
+    def start_logging(self, interval=300):
+        """每隔 interval 秒把摘要写到日志里，重复调用时替换之前的定时器"""
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._schedule(interval)
+
+    def _schedule(self, interval):
+        # 调用时需持有 _timer_lock
+        def run():
+            self.log_summary()
+            with self._timer_lock:
+                # 期间被停止或者替换时不再继续
+                if self._timer is timer:
+                    self._schedule(interval)
+
+        timer = self._timer = threading.Timer(interval, run)
+        timer.daemon = True
+        timer.start()
+
+    def stop_logging(self):
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+
+class CircuitBreaker:
+    """
+    熔断器。
+
+    连续 ``failure_threshold`` 次网络错误后进入 open 状态，``reset_timeout`` 秒内所有请求直接抛出
+    :class:`CircuitOpenError`；之后进入 half_open 状态放行一个试探请求，成功则恢复 closed，失败则重新 open。
+
+    状态变化时会调用通过 :meth:`add_listener` 注册的回调 ``callback(old_state, new_state)``。
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def retry_after(self):
+        """距离允许再次请求还有多少秒"""
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def _transit(self, state):
+        # 调用时需持有锁，返回需要通知的状态变化
+        old, self.state = self.state, state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        return (old, state) if old != state else None
+
+    def _notify(self, change):
+        if change is None:
+            return
+        log.warning('Circuit breaker %s -> %s', *change)
+        for callback in self._listeners:
+            try:
+                callback(*change)
+            except Exception:
+                log.exception('Circuit breaker listener failed')
+
+    def before_request(self):
+        """请求前调用，熔断期间抛出 :class:`CircuitOpenError`"""
+        change = None
+        with self._lock:
+            if self.state == self.OPEN:
+                retry_after = self.retry_after()
+                if retry_after > 0:
+                    raise CircuitOpenError(retry_after)
+                change = self._transit(self.HALF_OPEN)
+            elif self.state == self.HALF_OPEN and self._probing:
+                raise CircuitOpenError(1)
+            if self.state == self.HALF_OPEN:
+                self._probing = True
+        self._notify(change)
+
+    def record_success(self):
+        """服务器有响应（包括 API 返回的错误）"""
+        change = None
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                change = self._transit(self.CLOSED)
+        self._notify(change)
+
+    def record_failure(self):
+        """发生了网络错误"""
+        change = None
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                change = self._transit(self.OPEN)
+        self._notify(change)
+
+    def release(self):
+        """请求没有结果（例如程序出错或被中断）时调用，状态不变，下一个请求可以重新试探"""
+        with self._lock:
+            self._probing = False
+
+
+class RetryPolicy:
+    """
+    网络错误的重试策略。
+
+    * GET 请求，或者携带了 dedupe_key 的 POST 请求，出现网络错误后才会重试，避免超时的发消息请求被重复提交；
+      连接超时说明请求还没有发出，任何请求都可以重试
+    * 重试间隔为带随机抖动的指数退避
+    * 所有请求共用一个 :class:`CircuitBreaker`，服务器宕机时快速失败而不是每个请求都重试一遍
+    """
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=10, breaker=None):
+        """
+        :param int max_retries: 最多重试次数
+        :param float backoff: 第一次重试的最大等待秒数，之后每次翻倍
+        :param float max_backoff: 重试等待时间的上限
+        :param CircuitBreaker breaker: 熔断器
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+
+    def should_retry(self, method, error, attempt, deduplicated=False):
+        """
+        :param str method: HTTP 方法
+        :param NetworkError error: 本次请求的异常
+        :param int attempt: 已经重试的次数
+        :param bool deduplicated: 请求是否携带了 dedupe_key
+        """
+        if attempt >= self.max_retries or isinstance(error, CircuitOpenError):
+            return False
+        if isinstance(error, ConnectTimeout):
+            return True
+        return method in ('GET', 'HEAD') or deduplicated
+
+    def delay(self, attempt):
+        """第 attempt 次重试前等待的秒数"""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class cached_slot(object):
+    """ A property that is only computed once per instance and then stored
+        in the ``'_' + name`` slot, for classes defining ``__slots__``.
+        Deleting the attribute resets the property.
         """
 
     def __init__(self, func):
         self.__doc__ = getattr(func, '__doc__')
         self.func = func
+        self.slot = '_' + func.__name__
 
     def __get__(self, obj, cls):
         if obj is None:
             return self
-        value = obj.__dict__[self.func.__name__] = self.func(obj)
-        return value
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.func(obj)
+            setattr(obj, self.slot, value)
+            return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+    def __delete__(self, obj):
+        delattr(obj, self.slot)
 
 
 class FanfouError(Exception):
@@ -59,6 +1189,18 @@ class Timeout(NetworkError):
     pass
 
 
+class ConnectTimeout(Timeout):
+    """连接超时，请求还没有发出"""
+
+
+class CircuitOpenError(NetworkError):
+    """熔断期间请求被直接拒绝"""
+
+    def __init__(self, retry_after):
+        super().__init__('Circuit breaker is open, retry after {:.1f} seconds'.format(retry_after))
+        self.retry_after = retry_after
+
+
 class ApiRequestError(FanfouError):
     """API请求出错，参数错误、验证失败等"""
 
@@ -67,18 +1209,81 @@ class AuthError(ApiRequestError):
     pass
 
 
+class RateLimitError(ApiRequestError):
+    """超过了 API 的调用频率限制"""
+
+
+class _OAuth1Session(OAuth1Session):
+    """
+    签名时加锁的 OAuth1Session。
+    oauthlib 的 Client 不保证线程安全，签名和更新 token 都在同一把锁内进行；发送请求不持有锁。
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._sign_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def prepare_request(self, request):
+        with self._sign_lock:
+            return super().prepare_request(request)
+
+    def _populate_attributes(self, token):
+        with self._sign_lock:
+            super()._populate_attributes(token)
+
+
 class Fan:
     """
     API操作入口
+
+    并发约定：
+
+    * 同一个 Fan 可以在多个线程中共享，API 请求、限流、重试、缓存和中间件都是线程安全的
+    * 所有线程共用一个连接池，``pool_size`` 应不小于同时发出请求的线程数，否则多出的连接用完即弃
+    * OAuth 签名在锁内进行，只占用很短的时间，不会把请求串行化
+    * 授权流程（:meth:`authorization_url`, :meth:`oauth`, :meth:`xauth`）以及 :meth:`use` 注册中间件应在启动时单线程完成
     """
+    autoload = True
+    """:class:`Base` 对象缺少属性时是否自动发起请求加载"""
 
-    def __init__(self, consumer_key, consumer_secret, oauth_token=None, mobile=False):
+    def __init__(self, consumer_key, consumer_secret, oauth_token=None, mobile=False,
+                 rate_limiters=None, rate_limit_retries=2, retry_policy=None, cache=None,
+                 json_loads=None, pool_size=10, single_flight=True, copy_json=True, pager_prefetch=0):
+        """
+        :param dict rate_limiters: 各类 API 的限流器，键为 :func:`endpoint_class` 的返回值，
+            默认使用 :func:`default_rate_limiters`，传入空字典表示不限流
+        :param int rate_limit_retries: 被服务器限流时最多重试的次数
+        :param RetryPolicy retry_policy: 网络错误的重试策略
+        :param ResponseCache cache: 读取类 API 的响应缓存，默认不缓存
+        :param json_loads: 从响应的原始字节解析 JSON 的函数，默认为 :func:`default_json_loads` 的返回值
+        :param int pool_size: 每个主机保持的连接数，应与并发请求的线程数一致
+        :param bool single_flight: 是否合并并发的相同 GET 请求
+        :param bool copy_json: 为 False 时 :class:`User`/:class:`Status` 直接包装解析得到的 dict 而不复制，
+            对象的改动（例如自动加载的属性）会写回原数据，包括响应缓存中的数据
+        :param int pager_prefetch: 翻页读取列表（例如 :attr:`blocked_users_id`）时在后台预取的页数，默认不预取。
+            预取的请求在提前停止时会被浪费，关注者/好友列表使用 :data:`WALK_PREFETCH`。
+            预取的线程也占用连接，pool_size 应相应增加
+        """
         self._consumer_key = consumer_key
         self._consumer_secret = consumer_secret
         self._oauth_token = oauth_token
-        self._session = OAuth1Session(consumer_key, consumer_secret)
-        self._session.mount('http://', HTTPAdapter(max_retries=5))
-        self._session.mount('https://', HTTPAdapter(max_retries=5))
+        self._session = _OAuth1Session(consumer_key, consumer_secret)
+        # 重试由 retry_policy 负责
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self.rate_limiters = default_rate_limiters() if rate_limiters is None else rate_limiters
+        self.rate_limit_retries = rate_limit_retries
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self._dedupe = _DedupeResults()
+        self.cache = cache
+        self.single_flight = SingleFlight() if single_flight else None
+        self.copy_json = copy_json
+        self.pager_prefetch = pager_prefetch
+        self.users = IdentityMap()
+        self.json_loads = json_loads or default_json_loads()
+        self._middlewares = []
+        self._handler = self._request
 
         if oauth_token:
             self._session._populate_attributes(oauth_token)
@@ -91,10 +1296,15 @@ class Fan:
             if mobile else 'http://fanfou.com/oauth/authorize'
 
         self._me = None
+        self._me_lock = threading.Lock()
         self.draft_box = []
-        self.mentions = Timeline(self, None, 'statuses/mentions')
-        self.replies = Timeline(self, None, 'statuses/replies')
-        self.public_timeline = Timeline(self, None, 'statuses/public_timeline')
+        self.mentions = self.new_timeline(None, 'statuses/mentions')
+        self.replies = self.new_timeline(None, 'statuses/replies')
+        self.public_timeline = self.new_timeline(None, 'statuses/public_timeline')
+
+    def new_timeline(self, user_id, endpoint, **kwargs):
+        """创建绑定到此 Fan 的时间线"""
+        return Timeline(self, user_id, endpoint, **kwargs)
 
     @property
     def session(self):
@@ -160,8 +1370,13 @@ class Fan:
     def populate_token(self, token):
         self._session._populate_attributes(token)
 
-    def request(self, method, endpoint, params=None, data=None, files=None, **kwargs):
-        """发出请求"""
+    def request(self, method, endpoint, params=None, data=None, files=None, dedupe_key=None, **kwargs):
+        """
+        发出请求
+
+        :param dedupe_key: 去重键。携带此参数的 POST 请求在网络错误后也会重试，调用方需要保证重复提交无害；
+            同一个键的请求成功后不会再次提交，直接返回上次的结果
+        """
         # 1-tuple (not a tuple at all)
         # {fieldname: file_object}
         # 2-tuple
@@ -172,42 +1387,201 @@ class Fan:
         # {fieldname: (filename, file_object, content_type, headers)}
         kwargs.setdefault('timeout', (5, 5))
         url = 'http://api.fanfou.com/{}.json'.format(endpoint)
+        limiter = self.rate_limiters.get(endpoint_class(endpoint))
+        policy = self.retry_policy
+        if dedupe_key is not None:
+            found, result = self._dedupe.lookup(dedupe_key)
+            if found:
+                return result
+
+        attempt = limited = 0
+        while True:
+            policy.breaker.before_request()
+            if limiter is not None:
+                waited = limiter.acquire()
+                if waited > 1:
+                    log.info('Waited %.1f seconds for rate limit of %s', waited, endpoint)
+            try:
+                ctx = RequestContext(method, endpoint, url, dict(params=params, data=data, files=files, **kwargs))
+                result = self._handler(ctx)
+            except RateLimitError:
+                policy.breaker.record_success()
+                if limiter is not None:
+                    limiter.penalize()
+                # 上传的文件已被读取，不能重发
+                if files or limited >= self.rate_limit_retries:
+                    raise
+                limited += 1
+            except NetworkError as e:
+                policy.breaker.record_failure()
+                if files or not policy.should_retry(method, e, attempt, dedupe_key is not None):
+                    raise
+                delay = policy.delay(attempt)
+                log.warning('%s %s failed: %r, retry in %.1f seconds', method, endpoint, e, delay)
+                time.sleep(delay)
+                attempt += 1
+            except FanfouError:
+                policy.breaker.record_success()
+                raise
+            except BaseException:
+                policy.breaker.release()
+                raise
+            else:
+                policy.breaker.record_success()
+                if limiter is not None:
+                    limiter.reward()
+                if dedupe_key is not None:
+                    self._dedupe[dedupe_key] = result
+                return result
+
+    def use(self, middleware):
+        """
+        注册中间件。中间件接受下一层的处理函数，返回新的处理函数，
+        处理函数的参数是 :class:`RequestContext`，返回解析后的 JSON 数据。
+        先注册的中间件在最外层，网络错误等每次重试都会经过中间件。
+        """
+        self._middlewares.append(middleware)
+        handler = self._request
+        for mw in reversed(self._middlewares):
+            handler = mw(handler)
+        self._handler = handler
 
+    def _request(self, ctx):
         try:
-            response = self._session.request(method, url, params=params, data=data, files=files, **kwargs)
+            response = self._session.request(ctx.method, ctx.url, **ctx.kwargs)
+        except requests.ConnectTimeout:
+            raise ConnectTimeout
         except requests.Timeout:
             raise Timeout
-        except requests.ConnectionError:
+        except requests.RequestException:
             raise NetworkError
         else:
+            ctx.status_code = response.status_code
+            if ctx.kwargs.get('stream') and response.status_code == 200:
+                return self._iter_response(ctx, response)
             try:
-                json_data = response.json()
+                content = response.content
+            except requests.Timeout:
+                raise Timeout
+            except requests.RequestException:
+                # 例如 ChunkedEncodingError，响应体没有完整收到
+                raise NetworkError
+            ctx.response_size = len(content)
+            try:
+                json_data = self.json_loads(content)
             except ValueError:
                 raise ApiRequestError('Invalid server response')
-            if response.status_code == 200:
-                return json_data
-            if json_data.get('error'):
-                raise ApiRequestError(json_data['error'])
-            raise ApiRequestError('Invalid error response')
+            return _check_response(response.status_code, json_data)
+
+    @staticmethod
+    def _iter_content(ctx, response, chunk_size=8192):
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size):
+                size += len(chunk)
+                yield chunk
+        except requests.Timeout:
+            raise Timeout
+        except requests.RequestException:
+            raise NetworkError
+        finally:
+            ctx.response_size = size
+
+    def _iter_response(self, ctx, response):
+        try:
+            yield from iter_json_array(self._iter_content(ctx, response))
+        except ValueError:
+            raise ApiRequestError('Invalid server response')
+        finally:
+            response.close()
+
+    def iter_json(self, endpoint, **params):
+        """
+        请求返回数组的 API，边接收边解析，逐个产出数组元素。
+
+        与 :meth:`get` 一样经过限流、熔断、重试和中间件，但不使用响应缓存，也不合并请求。
+        中间件在收到响应头时就返回，``response_size`` 在数据接收完后才填入；
+        接收数据过程中的网络错误直接抛给调用方，不会重试。
+        """
+        params.setdefault('mode', 'lite')
+        params.setdefault('format', 'html')
+        return self.request('GET', endpoint, params=params, stream=True)
 
     def get(self, endpoint, **params):
         params.setdefault('mode', 'lite')
         params.setdefault('format', 'html')
-        return self.request('GET', endpoint, params=params)
+        cache = self.cache
+        key = ResponseCache.make_key(endpoint, params)
+        if cache is not None and endpoint in cache.ttl:
+            rv = cache.get(key)
+            if rv is not None:
+                return rv
+
+        def fetch():
+            rv = self.request('GET', endpoint, params=params)
+            if cache is not None:
+                cache.set(key, rv)
+            return rv
+
+        if self.single_flight is None:
+            return fetch()
+        return self.single_flight.do(key, fetch)
+
+    def rate_limit_stats(self):
+        """各类 API 限流器的统计信息，包括调用方累计等待的时间"""
+        return {name: limiter.stats() for name, limiter in self.rate_limiters.items()}
+
+    def hydrate(self, objs, attrs=None, max_workers=8):
+        """
+        批量加载 :class:`User`/:class:`Status` 对象缺少的属性，避免在循环里逐个触发自动加载。
+
+        找出缺少 attrs 中任一属性的对象，按 id 去重后并发请求，结果直接填入对象的 dict。
+        单个对象加载失败只记录日志，访问时仍会自动加载。
 
-    def post(self, endpoint, files=None, **data):
+        :param objs: User 或 Status 对象
+        :param attrs: 需要的属性，默认为该类的全部属性
+        :param int max_workers: 最多同时进行的请求数
+        :return: 加载成功的对象数（按 id 去重）
+        """
+        pending = _group_missing(objs, attrs)
+        if not pending:
+            return 0
+
+        loaded = 0
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            futures = {executor.submit(self.get, endpoint, id=id): (endpoint, id)
+                       for endpoint, id in pending}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    result = future.result()
+                except FanfouError as e:
+                    log.warning('Hydrate %s %s failed: %r', key[0], key[1], e)
+                    continue
+                for obj in pending[key]:
+                    obj.dict.update(result)
+                loaded += 1
+        return loaded
+
+    def post(self, endpoint, files=None, dedupe_key=None, **data):
         data.setdefault('mode', 'lite')
         data.setdefault('format', 'html')
-        return self.request('POST', endpoint, data=data, files=files)
+        try:
+            return self.request('POST', endpoint, data=data, files=files, dedupe_key=dedupe_key)
+        finally:
+            # 请求失败时也可能已经生效
+            if self.cache is not None:
+                self.cache.invalidate_after(endpoint)
 
     @property
     def me(self):
         """获取授权用户的信息"""
-        if self._me is None:
-            me = User.from_id(self)
-            me.mentions = self.mentions
-            me.replies = self.replies
-            self._me = me
+        with self._me_lock:
+            if self._me is None:
+                me = User.from_id(self)
+                me.mentions = self.mentions
+                me.replies = self.replies
+                self._me = me
         return self._me
 
     def update_status(self, status, photo=None,
@@ -215,7 +1589,8 @@ class Fan:
                       in_reply_to_status_id=None,
                       repost_status_id=None,
                       location=None,
-                      source=None):
+                      source=None,
+                      dedupe_key=None):
         """
         发表新状态，:meth:`Status.send()` 的快捷方式。
 
@@ -226,6 +1601,7 @@ class Fan:
         :param str repost_status_id: 要转发的消息ID
         :param str location: 位置信息，使用'地点名称' 或 '一个半角逗号分隔的经纬度坐标'
         :param str source: source 消息来源
+        :param dedupe_key: 去重键，参见 :meth:`request`
         """
         data = dict(status=status,
                     in_reply_to_user_id=in_reply_to_user_id,
@@ -236,7 +1612,7 @@ class Fan:
             if photo is not None:
                 result = self.post('photos/upload', files=dict(photo=photo), **data)
             else:
-                result = self.post('statuses/update', **data)
+                result = self.post('statuses/update', dedupe_key=dedupe_key, **data)
         except FanfouError:
             data['photo'] = photo
             self.draft_box.append(data)
@@ -364,11 +1740,259 @@ class Fan:
         return self.get('trends/list')
 
 
+class AsyncFan:
+    """
+    基于 asyncio 的 API 操作入口，接口与 :class:`Fan` 一致，但所有请求方法都是协程。
+
+    所有请求共用一个 aiohttp 连接池，一个进程可以同时发出大量请求，而不必每个请求占用一个线程。
+    授权需要先用 :class:`Fan` 完成，再把得到的 token 传进来。
+
+    .. attention::
+
+        异步模式下 :class:`User`/:class:`Status` 缺少属性时不会自动加载，需要显式 ``await fan.load(obj)``。
+    """
+    autoload = False
+
+    def __init__(self, consumer_key, consumer_secret, oauth_token=None, limit=100,
+                 rate_limiters=None, rate_limit_retries=2, retry_policy=None, json_loads=None,
+                 copy_json=True, pager_prefetch=0):
+        """
+        :param dict oauth_token: 包含 oauth_token 和 oauth_token_secret 的字典
+        :param int limit: 连接池最多同时打开的连接数
+        :param dict rate_limiters: 同 :class:`Fan`，可以与同一账号的 :class:`Fan` 共用
+        :param int rate_limit_retries: 被服务器限流时最多重试的次数
+        :param RetryPolicy retry_policy: 网络错误的重试策略
+        :param json_loads: 同 :class:`Fan`
+        :param bool copy_json: 同 :class:`Fan`
+        :param int pager_prefetch: :func:`async_pager` 并发预取的页数，默认不预取
+        """
+        if aiohttp is None:
+            raise RuntimeError('AsyncFan requires aiohttp to be installed')
+        oauth_token = oauth_token or {}
+        self._oauth_token = oauth_token
+        self._client = OAuth1Client(consumer_key, client_secret=consumer_secret,
+                                    resource_owner_key=oauth_token.get('oauth_token'),
+                                    resource_owner_secret=oauth_token.get('oauth_token_secret'))
+        self._limit = limit
+        self._session = None
+        self.rate_limiters = default_rate_limiters() if rate_limiters is None else rate_limiters
+        self.rate_limit_retries = rate_limit_retries
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self._dedupe = _DedupeResults()
+        self.json_loads = json_loads or default_json_loads()
+        self.copy_json = copy_json
+        self.pager_prefetch = pager_prefetch
+        self.users = IdentityMap()
+
+        self._me = None
+        self.draft_box = []
+        self.mentions = self.new_timeline(None, 'statuses/mentions')
+        self.replies = self.new_timeline(None, 'statuses/replies')
+        self.public_timeline = self.new_timeline(None, 'statuses/public_timeline')
+
+    def new_timeline(self, user_id, endpoint, **kwargs):
+        """创建绑定到此 AsyncFan 的时间线"""
+        return AsyncTimeline(self, user_id, endpoint, **kwargs)
+
+    @property
+    def session(self):
+        """获取 aiohttp session，第一次访问时在当前事件循环中创建"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._limit)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _sign(self, method, url, params=None, data=None, files=None):
+        """为请求生成 OAuth1 签名，返回 (url, headers, body)"""
+        params = _strip_none(params)
+        if params:
+            url = '{}?{}'.format(url, urlencode(params))
+        data = _strip_none(data)
+        if files:
+            # multipart 请求的 body 不参与签名
+            url, headers, _ = self._client.sign(url, method)
+            body = aiohttp.FormData(data)
+            for name, value in files.items():
+                if isinstance(value, (tuple, list)):
+                    body.add_field(name, value[1], filename=value[0],
+                                   content_type=value[2] if len(value) > 2 else None)
+                elif isinstance(value, str) and os.path.isfile(value):
+                    with open(value, 'rb') as f:
+                        body.add_field(name, f.read(), filename=os.path.basename(value))
+                else:
+                    body.add_field(name, value, filename=name)
+        elif method == 'POST':
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+            url, headers, body = self._client.sign(url, method, urlencode(data), headers)
+        else:
+            url, headers, body = self._client.sign(url, method)
+        return url, headers, body
+
+    async def request(self, method, endpoint, params=None, data=None, files=None, dedupe_key=None,
+                      timeout=(5, 5)):
+        """发出请求，参数同 :meth:`Fan.request`"""
+        url = 'http://api.fanfou.com/{}.json'.format(endpoint)
+        limiter = self.rate_limiters.get(endpoint_class(endpoint))
+        policy = self.retry_policy
+        if dedupe_key is not None:
+            found, result = self._dedupe.lookup(dedupe_key)
+            if found:
+                return result
+
+        attempt = limited = 0
+        while True:
+            policy.breaker.before_request()
+            if limiter is not None:
+                waited = limiter.reserve()
+                if waited:
+                    if waited > 1:
+                        log.info('Waited %.1f seconds for rate limit of %s', waited, endpoint)
+                    await asyncio.sleep(waited)
+            try:
+                result = await self._request(method, url, params, data, files, timeout)
+            except RateLimitError:
+                policy.breaker.record_success()
+                if limiter is not None:
+                    limiter.penalize()
+                if files or limited >= self.rate_limit_retries:
+                    raise
+                limited += 1
+            except NetworkError as e:
+                policy.breaker.record_failure()
+                if files or not policy.should_retry(method, e, attempt, dedupe_key is not None):
+                    raise
+                delay = policy.delay(attempt)
+                log.warning('%s %s failed: %r, retry in %.1f seconds', method, endpoint, e, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+            except FanfouError:
+                policy.breaker.record_success()
+                raise
+            except BaseException:
+                policy.breaker.release()
+                raise
+            else:
+                policy.breaker.record_success()
+                if limiter is not None:
+                    limiter.reward()
+                if dedupe_key is not None:
+                    self._dedupe[dedupe_key] = result
+                return result
+
+    async def _request(self, method, url, params, data, files, timeout):
+        url, headers, body = self._sign(method, url, params, data, files)
+        client_timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+
+        try:
+            async with self.session.request(method, url, headers=headers, data=body,
+                                            timeout=client_timeout) as response:
+                status_code = response.status
+                content = await response.read()
+        except _aiohttp_connect_timeout:
+            raise ConnectTimeout
+        except asyncio.TimeoutError:
+            raise Timeout
+        except aiohttp.ClientError:
+            raise NetworkError
+
+        try:
+            json_data = self.json_loads(content)
+        except ValueError:
+            raise ApiRequestError('Invalid server response')
+        return _check_response(status_code, json_data)
+
+    async def get(self, endpoint, **params):
+        params.setdefault('mode', 'lite')
+        params.setdefault('format', 'html')
+        return await self.request('GET', endpoint, params=params)
+
+    def rate_limit_stats(self):
+        """各类 API 限流器的统计信息，包括调用方累计等待的时间"""
+        return {name: limiter.stats() for name, limiter in self.rate_limiters.items()}
+
+    async def post(self, endpoint, files=None, dedupe_key=None, **data):
+        data.setdefault('mode', 'lite')
+        data.setdefault('format', 'html')
+        return await self.request('POST', endpoint, data=data, files=files, dedupe_key=dedupe_key)
+
+    async def load(self, obj):
+        """加载 :class:`User`/:class:`Status` 对象的全部属性"""
+        result = await self.get(obj.endpiont, id=obj.dict.get('id'))
+        obj.dict.update(result)
+        return obj
+
+    async def hydrate(self, objs, attrs=None, max_workers=8):
+        """批量加载对象缺少的属性，参数同 :meth:`Fan.hydrate`"""
+        pending = _group_missing(objs, attrs)
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def load(endpoint, id):
+            async with semaphore:
+                try:
+                    result = await self.get(endpoint, id=id)
+                except FanfouError as e:
+                    log.warning('Hydrate %s %s failed: %r', endpoint, id, e)
+                    return 0
+            for obj in pending[(endpoint, id)]:
+                obj.dict.update(result)
+            return 1
+
+        loaded = await asyncio.gather(*(load(endpoint, id) for endpoint, id in pending))
+        return sum(loaded)
+
+    async def get_me(self):
+        """获取授权用户的信息"""
+        if self._me is None:
+            me = User.from_json(self, await self.get(User.endpiont))
+            me.mentions = self.mentions
+            me.replies = self.replies
+            self._me = me
+        return self._me
+
+    async def update_status(self, status, photo=None,
+                            in_reply_to_user_id=None,
+                            in_reply_to_status_id=None,
+                            repost_status_id=None,
+                            location=None,
+                            source=None,
+                            dedupe_key=None):
+        """发表新状态，参数同 :meth:`Fan.update_status`"""
+        data = dict(status=status,
+                    in_reply_to_user_id=in_reply_to_user_id,
+                    in_reply_to_status_id=in_reply_to_status_id,
+                    repost_status_id=repost_status_id,
+                    locaion=location, source=source)
+        try:
+            if photo is not None:
+                result = await self.post('photos/upload', files=dict(photo=photo), **data)
+            else:
+                result = await self.post('statuses/update', dedupe_key=dedupe_key, **data)
+        except FanfouError:
+            data['photo'] = photo
+            self.draft_box.append(data)
+            raise
+
+        return Status.from_json(self, result)
+
+
 class Base:
     """
     :class:`User` 和 :class:`Status` 的基类。
     为子类提供对象缓存和自动加载功能。
+    子类都定义了 ``__slots__``，长时间运行的轮询中每条消息占用的内存更少。
     """
+    __slots__ = ('fan', 'dict', '_created_at')
     endpiont = None
     attrs = ('id',)
 
@@ -378,20 +2002,31 @@ class Base:
 
     def __getattr__(self, item):
         if item in self.attrs:
-            if item not in self.dict:
+            if item not in self.dict and self.fan.autoload:
                 id = self.dict.get('id')
                 result = self.fan.get(self.endpiont, id=id)
                 self.dict.update(result)
             return self.dict.get(item)
         raise AttributeError
 
+    @cached_slot
+    def created_at(self):
+        """创建时间，带时区的 datetime，第一次访问时才解析"""
+        value = self.__getattr__('created_at')
+        return parse_created_at(value) if value else None
+
     @classmethod
     def from_json(cls, fan, data):
         if not data:
             return None
 
-        data = data.copy()
-        return cls(fan, **data)
+        if fan.copy_json:
+            return cls(fan, **data)
+        # 直接包装解析好的 dict，不复制
+        obj = cls.__new__(cls)
+        obj.fan = fan
+        obj.dict = data
+        return obj
 
     @classmethod
     def from_id(cls, fan, id=None):
@@ -405,9 +2040,30 @@ class Base:
 class Timeline:
     """
     时间线管理类
+
+    除了 fetch 系列方法，还可以像文件一样用游标顺序读取（:meth:`read`, :meth:`seek`, 或直接在 for 循环中使用）。
+    读取的消息保存在最多 `window` 条的环形缓冲区中，游标前进时在后台预取更旧的一页，
+    落在窗口之外的旧位置被丢弃，遍历很长的时间线时占用的内存不变。
+    游标读取有自己的翻页位置，不影响 fetch_older/fetch_newer 的游标。
     """
 
-    def __init__(self, fan, user_id, endpoint, max_id=None, since_id=None):
+    def __init__(self, fan, user_id, endpoint, max_id=None, since_id=None,
+                 window=600, page_size=60, prefetch=True, max_backfill=0, dedup=None,
+                 journal=None, journal_key=None):
+        """
+        :param int window: 缓冲区最多保存的消息数，至少为两页
+        :param int page_size: 游标读取时每次获取的数量，最大为60
+        :param bool prefetch: 是否在后台预取下一页
+        :param int max_backfill: fetch_newer 拿到整页新消息、与已见过的消息没有重叠时，
+            最多再用 max_id 往前补取的页数，为 0 时不补取。max_id 不管用的 API（例如 public_timeline）不要开启
+        :param dedup: 去重组件，例如 :class:`SeenFilter`。设置后 fetch_newer 按 id 去掉处理过的消息，
+            不再只比较游标，顺序错乱的消息不会被丢弃，获取范围有重叠也不会重复处理
+        :param StateJournal journal: 记录游标的状态存储，创建时从中恢复没有指定的 max_id/since_id，
+            游标移动后写入新的位置
+        :param str journal_key: 游标在 journal 中的键，默认为 API 名加上用户 ID
+        """
+        self.journal = journal
+        self.journal_key = journal_key or ('{}:{}'.format(endpoint, user_id) if user_id else endpoint)
         self.fan = fan
         self.user_id = user_id  # type:User
         """:class:`~van.User` 时间线的主人"""
@@ -416,74 +2072,173 @@ class Timeline:
         self._max_rawid = -1
         self._since_id = since_id
         self._since_rawid = 1 << 32  # 什么时候饭否消息会达到这个数字呢？
+        self._saved_cursor = None
+        if journal is not None:
+            self._saved_cursor = journal.get(self.journal_key)
+            saved = self._saved_cursor or {}
+            # 同时恢复 rawid，否则过滤和游标比较都会失效，fetch_older 会把游标移回旧的位置
+            if max_id is None and saved.get('max_id'):
+                self._max_id = saved['max_id']
+                self._max_rawid = saved.get('max_rawid', -1)
+            if since_id is None and saved.get('since_id'):
+                self._since_id = saved['since_id']
+                self._since_rawid = saved.get('since_rawid', 1 << 32)
+        # 流式获取中途停止时已经产出的消息，游标移动后清空
+        self._yielded_older = set()
+        self._yielded_newer = set()
+        # 游标读取：_pool[0] 的位置是 _offset，_curr 是游标的位置，都是从最新的消息开始数的绝对位置
+        self.page_size = page_size
+        self._pool = deque(maxlen=max(window, 2 * page_size))
+        self._offset = 0
+        self._curr = 0
+        self._exhausted = False
+        self._prefetch = prefetch
+        self._executor = None
+        self._pending = None  # (max_id, Future)
+        self.max_backfill = max_backfill
+        self.recovered = 0  # 上一次 fetch_newer 补取到的消息数
+        self.recovered_total = 0
+        self.backfill_requests = 0  # 上一次 fetch_newer 补取发出的请求数
+        self.dedup = dedup
+        self._subscribers = []
+        self.published = 0  # 发布给订阅者的消息数
+
+    def tell(self):
+        """
+        返回当前游标的位置
+
+        :rtype: int
+        """
+        return self._curr
+
+    def rewind(self):
+        """
+        获取最新的消息插入到缓冲区的头部，并将游标置为0（指向最新的消息）。
+        新消息超过一页时中间可能有空缺，此时清空缓冲区，从最新的一页重新开始。
+
+        :rtype: int
+        """
+        self._cancel_prefetch()
+        since_id = self._pool[0].id if self._pool else None
+        newest = self._pool[0].rawid if self._pool else -1
+        rv = [s for s in self.fetch(since_id=since_id, count=self.page_size) if s.rawid > newest]
+        if len(rv) >= self.page_size:
+            self._pool.clear()
+        if rv:
+            # 缓冲区满时 extendleft 会丢弃最旧的消息，之后从新的末尾继续翻页
+            self._exhausted = False
+            self._pool.extendleft(reversed(rv))
+        self._offset = self._curr = 0
+        self._maybe_prefetch()
+        return 0
+
+    def seek(self, offset=None, whence=0):
+        """
+        移动游标的位置
+
+        :param int offset: 偏移量
+        :param int whence: 相对位置
+
+            * 0 -- 相对于时间线开始位置，偏移量必须 >= 0
+            * 1 -- 相对于当前游标位置，偏移量可正可负，超出范围的偏移量会被纠正为边界值
+            * 2 -- 相对于缓冲区结尾，偏移量 <=0
+
+        .. attention::
+
+            此函数只能在缓冲区范围内满足索引要求，超出范围的偏移量会被自动纠正为合法值，
+            已经被丢弃的位置会被纠正为缓冲区中最新的位置。
+
+        :return: 移动后的游标位置
+        :rtype: int
+        """
+        if not self._pool:
+            self._fetch_page()
+
+        end = self._offset + len(self._pool)
+        if whence == 0:
+            if offset < 0:
+                raise ValueError('offset should be zero or positive while whence=0')
+            curr = offset
+        elif whence == 1:
+            curr = self._curr + offset
+        else:
+            if offset > 0:
+                raise ValueError('offset should be zero or negative while whence=2')
+            curr = end + offset
+        self._curr = min(max(curr, self._offset), max(end - 1, self._offset))
+        self._maybe_prefetch()
+        return self._curr
+
+    def read(self, count=10):
+        """
+        从当前游标位置处往后读取 `count` 条消息, 数组长度可能小于要求的大小。
 
-    # def tell(self):
-    #     """
-    #     返回当前游标的位置
-    #
-    #     :rtype: int
-    #     """
-    #     return self._curr
-
-    # def rewind(self):
-    #     """
-    #     获取最新的状态插入到时间线的头部，并将指针置为0（指向最新的状态）
-    #
-    #     :rtype: int
-    #     """
-    #     self._fetch_newer()
-    #     self._curr = 0
-    #     return 0
-
-    # def seek(self, offset=None, whence=0):
-    #     """
-    #     移动游标的位置
-    #
-    #     :param int offset: 偏移量
-    #     :param int whence: 相对位置
-    #
-    #         * 0 -- 相对于时间线开始位置，偏移量必须 >= 0
-    #         * 1 -- 相对于当前游标位置，偏移量可正可负，超出范围的偏移量会被纠正为边界值
-    #         * 2 -- 相对于时间线结尾，偏移量 <=0
-    #
-    #     .. attention::
-    #
-    #         此函数只能在有限范围满足索引要求，超出范围太多的偏移量会被自动纠正为合法值。
-    #
-    #     :return: 移动后的游标位置
-    #     :rtype: int
-    #     """
-    #     if not self._pool:
-    #         self._fetch_older()
-    #
-    #     if whence == 0:
-    #         if offset < 0:
-    #             raise ValueError('offset should be zero or positive while whence=0')
-    #         self._curr = min(offset, max(len(self._pool) - 1, 0))
-    #     elif whence == 1:
-    #         self._curr += offset
-    #         self._curr = min(max(self._curr, 0), len(self._pool) - 1)
-    #     else:
-    #         if offset > 0:
-    #             raise ValueError('offset should be zero or negative while whence=2')
-    #         else:
-    #             self._curr = max(len(self._pool) + offset, 0)
-    #     return self._curr
-
-    # def read(self, count=10):
-    #     """
-    #     从当前游标位置处往后读取 `count` 条消息, 数组长度可能小于要求的大小。
-    #
-    #     :param int count: 读取数量
-    #     :return: :class:`Status` 数组
-    #     :rtype: [Status]
-    #     """
-    #     while self._curr + count >= len(self._pool):
-    #         if self._fetch_older() == 0:
-    #             break
-    #     rv = self._pool[self._curr:self._curr + count]
-    #     self._curr += len(rv)
-    #     return rv
+        :param int count: 读取数量
+        :return: :class:`Status` 数组
+        :rtype: [Status]
+        """
+        rv = []
+        while len(rv) < count:
+            index = self._curr - self._offset
+            if index >= len(self._pool):
+                if not self._fetch_page():
+                    break
+                continue
+            taken = list(itertools.islice(self._pool, index, index + count - len(rv)))
+            rv.extend(taken)
+            self._curr += len(taken)
+            self._maybe_prefetch()
+        return rv
+
+    def close(self):
+        """停止后台预取"""
+        self._cancel_prefetch()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _next_max_id(self):
+        return self._pool[-1].id if self._pool else None
+
+    def _fetch_page(self):
+        """获取缓冲区末尾之后更旧的一页，返回新加入的消息数"""
+        if self._exhausted:
+            return 0
+        max_id = self._next_max_id()
+        pending, self._pending = self._pending, None
+        if pending is not None and pending[0] == max_id:
+            rv = pending[1].result()
+        else:
+            if pending is not None:
+                pending[1].cancel()
+            rv = self.fetch(max_id=max_id, count=self.page_size)
+        if self._pool:
+            # max_id 对应的消息本身也可能被返回
+            oldest = self._pool[-1].rawid
+            rv = [s for s in rv if s.rawid < oldest]
+        if not rv:
+            self._exhausted = True
+            return 0
+        dropped = max(len(self._pool) + len(rv) - self._pool.maxlen, 0)
+        self._pool.extend(rv)
+        self._offset += dropped
+        return len(rv)
+
+    def _maybe_prefetch(self):
+        if not self._prefetch or self._exhausted or self._pending is not None or not self._pool:
+            return
+        ahead = self._offset + len(self._pool) - self._curr
+        if ahead >= self.page_size:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='timeline-prefetch')
+        max_id = self._next_max_id()
+        self._pending = (max_id, self._executor.submit(self.fetch, max_id=max_id, count=self.page_size))
+
+    def _cancel_prefetch(self):
+        if self._pending is not None:
+            self._pending[1].cancel()
+            self._pending = None
 
     def fetch(self, since_id=None, max_id=None, count=10):
         """
@@ -500,40 +2255,956 @@ class Timeline:
                           since_id=since_id, max_id=max_id, count=count)
         return [Status.from_json(self.fan, s) for s in rv]
 
+    def iter_fetch(self, since_id=None, max_id=None, count=10):
+        """
+        :meth:`fetch` 的流式版本，边接收边解析，逐条产出 :class:`Status`，参数同 :meth:`fetch`
+        """
+        for s in self.fan.iter_json(self.endpoint, id=self.user_id,
+                                    since_id=since_id, max_id=max_id, count=count):
+            yield Status.from_json(self.fan, s)
+
     def fetch_older(self, max_id=None, count=10):
         rv = self.fetch(max_id=max_id or self._since_id, count=count)
+        return self._advance_older(rv)
+
+    def fetch_newer(self, since_id=None, count=10):
+        """
+        获取比游标新的消息。设置了 `max_backfill` 时，一次轮询之间到达的消息超过 `count` 条，
+        会继续往前补取，直到与已见过的消息重叠，返回的消息仍然从新到旧排列。
+        """
+        since_id = since_id or self._max_id
+        rv = self.fetch(since_id=since_id, count=count)
+        rv += self._backfill(rv, since_id, count)
+        rv = self._advance_newer(rv)
+        self.checkpoint()
+        self._publish(rv)
+        return rv
+
+    def _backfill(self, page, since_id, count):
+        """在 page 之前补取被跳过的新消息"""
+        rv = []
+        pages = 0
+        while pages < self.max_backfill and self._backfill_wanted(page, since_id, count):
+            raw = self.fetch(since_id=since_id, max_id=page[-1].id, count=count)
+            pages += 1
+            more = self._backfill_filter(page, raw)
+            if not more:
+                break
+            rv += more
+            page = raw
+        self._report_backfill(rv, pages, page, since_id, count)
+        return rv
+
+    def _backfill_wanted(self, page, since_id, count):
+        """这一页是满的，并且最旧的一条仍然比已见过的消息新"""
+        if len(page) < count or (self._max_rawid < 0 and not since_id):
+            return False
+        return page[-1].rawid > self._max_rawid
+
+    def _backfill_filter(self, page, raw):
+        """去掉补取结果中 max_id 本身和已见过的消息"""
+        oldest = page[-1].rawid
+        return [s for s in raw if self._max_rawid < s.rawid < oldest]
+
+    def _report_backfill(self, rv, pages, page, since_id, count):
+        self.recovered = len(rv)
+        self.recovered_total += len(rv)
+        self.backfill_requests = pages
+        if rv:
+            log.info('Recovered %d statuses of %s with %d extra requests', len(rv), self.endpoint, pages)
+        if pages >= self.max_backfill > 0 and self._backfill_wanted(page, since_id, count):
+            log.warning('Backfill of %s stopped after %d pages, some statuses may be missed',
+                        self.endpoint, pages)
+
+    def iter_older(self, max_id=None, count=10):
+        """
+        :meth:`fetch_older` 的流式版本。
+        整页接收完后才移动游标。中途停止或出错时，下次调用会重新获取这一页，但不会重复产出已经产出过的消息。
+        """
+        yielded = self._yielded_older
+        page = []
+        for status in self.iter_fetch(max_id=max_id or self._since_id, count=count):
+            page.append(status)
+            if status.rawid not in yielded:
+                yielded.add(status.rawid)
+                yield status
+        self._advance_older(page)
+        yielded.clear()
+
+    def iter_newer(self, since_id=None, count=10):
+        """
+        :meth:`fetch_newer` 的流式版本，只产出比游标新的消息。
+        整页接收完后才移动游标。中途停止或出错时，下次调用会重新获取这一页，但不会重复产出已经产出过的消息。
+        """
+        since_id = since_id or self._max_id
+        max_rawid = self._max_rawid
+        yielded = self._yielded_newer
+        page = []
+        for status in self.iter_fetch(since_id=since_id, count=count):
+            page.append(status)
+            if self._unseen(status, max_rawid) and status.rawid not in yielded:
+                yielded.add(status.rawid)
+                self._publish((status,))
+                yield status
+        # 补取的消息不流式解析
+        for status in self._backfill(list(page), since_id, count):
+            page.append(status)
+            if self._unseen(status, max_rawid) and status.rawid not in yielded:
+                yielded.add(status.rawid)
+                self._publish((status,))
+                yield status
+        self._advance_newer(page)
+        self.checkpoint()
+        yielded.clear()
+
+    def subscribe(self, maxsize=1000, policy='drop', spill_dir=None):
+        """
+        订阅这个时间线的新消息。
+
+        时间线只需要由一个轮询者（例如 :class:`AdaptivePoller`）调用 fetch_newer/iter_newer，
+        获取到的新消息会发布给所有订阅者，无论有多少订阅者都只请求一次。
+        每个订阅者有自己的缓冲区和读取位置，缓冲区满时按 `policy` 处理：
+
+        * ``'drop'`` -- 丢弃最旧的消息
+        * ``'block'`` -- 阻塞发布者，直到订阅者读取或者取消订阅
+        * ``'spill'`` -- 把最旧的消息以快照格式写到 `spill_dir` 中的临时文件，读取时按顺序读回，需要 msgpack
+
+        :param int maxsize: 内存中缓冲的消息数
+        :param str policy: 缓冲区满时的处理方式
+        :param str spill_dir: 临时文件的目录，默认为系统临时目录
+        :rtype: Subscription
+        """
+        subscription = Subscription(self, maxsize, policy, spill_dir)
+        self._subscribers.append(subscription)
+        return subscription
+
+    def archive(self, path, limit=None, **kwargs):
+        """
+        把时间线的全部历史消息导出到文件，中断后再次调用会继续，参数见 :class:`TimelineArchiver`
+
+        :return: :meth:`TimelineArchiver.stats`
+        :rtype: dict
+        """
+        with TimelineArchiver(self, path, **kwargs) as archiver:
+            return archiver.run(limit)
+
+    def _publish(self, statuses):
+        if not statuses:
+            return
+        self.published += len(statuses)
+        for subscription in list(self._subscribers):
+            subscription.put(statuses)
+
+    def _unseen(self, status, max_rawid):
+        """消息是否没有处理过：设置了 dedup 时查询 dedup，否则与游标比较"""
+        if self.dedup is not None:
+            return status.rawid not in self.dedup
+        return status.rawid > max_rawid
+
+    def _advance_older(self, rv):
+        """根据获取到的旧消息移动游标"""
         if rv:
             self._since_id = rv[-1].id
             self._since_rawid = rv[-1].rawid
             if rv[0].rawid > self._max_rawid:
                 self._max_id = rv[0].id
                 self._max_rawid = rv[0].rawid
+            self.checkpoint()
         return rv
 
-    def fetch_newer(self, since_id=None, count=10):
-        rv = self.fetch(since_id=since_id or self._max_id, count=count)
+    def checkpoint(self):
+        """把游标写入 journal，没有变化时不写。游标移动后会自动调用，迁移旧版本保存的位置时可以立即调用"""
+        if self.journal is None:
+            return
+        cursor = {'max_id': self._max_id, 'max_rawid': self._max_rawid,
+                  'since_id': self._since_id, 'since_rawid': self._since_rawid}
+        if cursor != self._saved_cursor:
+            self.journal.set(self.journal_key, cursor)
+            self._saved_cursor = cursor
+
+    def _advance_newer(self, rv):
+        """根据获取到的新消息移动游标，返回真正新的消息"""
+        # public timeline 好像 since_id 和 max_id 不管用
+        new_rv = []
         if rv:
-            self._max_id = rv[0].id
-            self._max_rawid = rv[0].rawid
-            if rv[0].rawid < self._since_rawid:
-                self._since_id = rv[-1].id
-                self._since_rawid = rv[-1].rawid
+            for status in rv:
+                if self.dedup is not None:
+                    if not self.dedup.add(status.rawid):
+                        continue
+                elif status.rawid <= self._max_rawid:
+                    continue
+                new_rv.append(status)
+            if new_rv:
+                # 使用 dedup 时可能有比游标旧的消息
+                newest = max(new_rv, key=lambda s: s.rawid)
+                oldest = min(new_rv, key=lambda s: s.rawid)
+                if newest.rawid > self._max_rawid:
+                    self._max_id = newest.id
+                    self._max_rawid = newest.rawid
+                if newest.rawid < self._since_rawid:
+                    self._since_id = oldest.id
+                    self._since_rawid = oldest.rawid
+        return new_rv
+
+    def __iter__(self):
+        """
+        从当前游标位置开始获取消息，可以像普通数组一样在循环中使用。
+        :return: :class:`Status`
+        """
+        while True:
+            rv = self.read(1)
+            if not rv:
+                return
+            yield rv[0]
+
+    @property
+    def buffered(self):
+        """缓冲区中的消息数。不定义 __len__，否则空的时间线在 ``if timeline:`` 中会被当作假"""
+        return len(self._pool)
+
+
+class AsyncTimeline(Timeline):
+    """
+    :class:`Timeline` 的异步版本，由 :class:`AsyncFan` 创建，各 fetch 方法都是协程
+    """
+
+    async def fetch(self, since_id=None, max_id=None, count=10):
+        rv = await self.fan.get(self.endpoint, id=self.user_id,
+                                since_id=since_id, max_id=max_id, count=count)
+        return [Status.from_json(self.fan, s) for s in rv]
+
+    async def fetch_older(self, max_id=None, count=10):
+        rv = await self.fetch(max_id=max_id or self._since_id, count=count)
+        return self._advance_older(rv)
+
+    async def fetch_newer(self, since_id=None, count=10):
+        since_id = since_id or self._max_id
+        rv = await self.fetch(since_id=since_id, count=count)
+        page = rv
+        recovered = []
+        pages = 0
+        while pages < self.max_backfill and self._backfill_wanted(page, since_id, count):
+            raw = await self.fetch(since_id=since_id, max_id=page[-1].id, count=count)
+            pages += 1
+            more = self._backfill_filter(page, raw)
+            if not more:
+                break
+            recovered += more
+            page = raw
+        self._report_backfill(recovered, pages, page, since_id, count)
+        rv = self._advance_newer(rv + recovered)
+        self.checkpoint()
+        self._publish(rv)
         return rv
-    #
-    # def __iter__(self):
-    #     """
-    #     从当前游标位置开始获取消息，可以像普通数组一样在循环中使用。
-    #     :return: :class:`Status`
-    #     """
-    #     while True:
-    #         if self._curr >= len(self._pool):
-    #             if self.fetch_older() == 0:
-    #                 return
-    #         yield self._pool[self._curr]
-    #         self._curr += 1
-    #
-    # def __len__(self):
-    #     return len(self._pool)
+
+    async def iter_fetch(self, since_id=None, max_id=None, count=10):
+        """异步版本暂不流式解析，接收完整页后逐条产出"""
+        for status in await self.fetch(since_id=since_id, max_id=max_id, count=count):
+            yield status
+
+    async def iter_older(self, max_id=None, count=10):
+        for status in await self.fetch_older(max_id=max_id, count=count):
+            yield status
+
+    async def iter_newer(self, since_id=None, count=10):
+        for status in await self.fetch_newer(since_id=since_id, count=count):
+            yield status
+
+    def subscribe(self, maxsize=1000, policy='drop', spill_dir=None):
+        """
+        同 :meth:`Timeline.subscribe`，但只支持 ``'drop'``：消息在事件循环中发布，
+        ``'block'`` 会阻塞整个事件循环，同一个循环中的订阅者永远读不到消息而死锁；``'spill'`` 会在事件循环中读写文件。
+        在协程中读取时使用 ``get(block=False)``。
+        """
+        if policy != 'drop':
+            raise ValueError("AsyncTimeline only supports policy='drop'")
+        return super(AsyncTimeline, self).subscribe(maxsize, policy, spill_dir)
+
+    def _no_cursor(self, *args, **kwargs):
+        raise TypeError('AsyncTimeline does not support cursor reading, use iter_older/iter_newer')
+
+    # 游标读取会同步调用 fetch，异步版本不支持
+    read = seek = rewind = _fetch_page = _maybe_prefetch = __iter__ = _no_cursor
+
+    def archive(self, path, limit=None, **kwargs):
+        raise TypeError('AsyncTimeline does not support archiving, use a Timeline of a Fan')
+
+
+class Subscription:
+    """
+    :meth:`Timeline.subscribe` 返回的订阅，可以在 for 循环中使用，取消订阅后结束
+    """
+
+    policies = ('drop', 'block', 'spill')
+
+    def __init__(self, timeline, maxsize=1000, policy='drop', spill_dir=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown policy {!r}'.format(policy))
+        if policy == 'spill' and msgpack is None:
+            raise RuntimeError('Spilling to disk requires msgpack to be installed')
+        self.timeline = timeline
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self._cond = threading.Condition()
+        self._buffer = deque()
+        self._closed = False
+        # 写到磁盘的消息都比内存中的旧，按文件顺序读回
+        self._segments = deque()  # 已经写完的文件
+        self._writer = None  # (path, fp, SnapshotWriter)
+        self._reader = None  # (path, fp, iterator)
+        self.spilled = 0  # 在磁盘上等待读取的消息数
+        self.consumed = 0  # 读取的位置
+        self.dropped = 0
+
+    def __len__(self):
+        """等待读取的消息数"""
+        return len(self._buffer) + self.spilled
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put(self, statuses):
+        """发布消息，由 :class:`Timeline` 调用"""
+        with self._cond:
+            for status in statuses:
+                if self._closed:
+                    return
+                if len(self._buffer) >= self.maxsize:
+                    if self.policy == 'drop':
+                        self._buffer.popleft()
+                        self.dropped += 1
+                    elif self.policy == 'block':
+                        self._cond.wait_for(lambda: len(self._buffer) < self.maxsize or self._closed)
+                        if self._closed:
+                            return
+                    else:
+                        self._spill(self._buffer.popleft())
+                self._buffer.append(status)
+                self._cond.notify_all()
+
+    def get(self, block=True, timeout=None):
+        """
+        读取一条消息
+
+        :raises queue.Empty: 没有消息并且不阻塞、超时或者已经取消订阅
+        """
+        with self._cond:
+            if block:
+                self._cond.wait_for(lambda: len(self) or self._closed, timeout)
+            status = self._next()
+            if status is None:
+                raise queue.Empty
+            self.consumed += 1
+            self._cond.notify_all()
+            return status
+
+    def drain(self):
+        """读取所有等待中的消息，不阻塞"""
+        rv = []
+        while True:
+            try:
+                rv.append(self.get(block=False))
+            except queue.Empty:
+                return rv
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except queue.Empty:
+                if self._closed:
+                    return
+
+    def close(self):
+        """取消订阅，删除临时文件"""
+        with self._cond:
+            self._closed = True
+            if self in self.timeline._subscribers:
+                self.timeline._subscribers.remove(self)
+            if self._writer is not None:
+                self._segments.append(self._close_file(self._writer))
+                self._writer = None
+            if self._reader is not None:
+                os.remove(self._close_file(self._reader))
+                self._reader = None
+            while self._segments:
+                os.remove(self._segments.popleft())
+            self._buffer.clear()
+            self.spilled = 0
+            self._cond.notify_all()
+
+    @staticmethod
+    def _close_file(file):
+        path, fp, _ = file
+        fp.close()
+        return path
+
+    def _spill(self, status):
+        if self._writer is None:
+            fd, path = tempfile.mkstemp(prefix='van-spill-', suffix='.bin', dir=self.spill_dir)
+            fp = os.fdopen(fd, 'wb')
+            self._writer = (path, fp, SnapshotWriter(fp))
+        self._writer[2].write(status)
+        self.spilled += 1
+
+    def _next(self):
+        while self.spilled:
+            if self._reader is None:
+                if not self._segments:
+                    # 正在写的文件也要读了，之后写到新文件
+                    self._segments.append(self._close_file(self._writer))
+                    self._writer = None
+                path = self._segments.popleft()
+                fp = open(path, 'rb')
+                self._reader = (path, fp, iter(SnapshotReader(self.timeline.fan, fp)))
+            status = next(self._reader[2], None)
+            if status is not None:
+                self.spilled -= 1
+                if not self.spilled:
+                    os.remove(self._close_file(self._reader))
+                    self._reader = None
+                return status
+            os.remove(self._close_file(self._reader))
+            self._reader = None
+        if self._buffer:
+            return self._buffer.popleft()
+        return None
+
+
+class AdaptivePoller:
+    """
+    按消息到达的速度自动调整轮询间隔和每次获取的数量，代替手写的空闲等待::
+
+        poller = AdaptivePoller(fan.mentions, target_latency=5)
+        while True:
+            poller.wait()
+            for status in poller.poll():
+                ...
+
+    用指数加权移动平均 (EWMA) 估计消息的到达速度。有消息时，轮询间隔取 2 倍的目标延迟
+    （消息均匀到达时平均延迟为间隔的一半），同时保证一个间隔内预计到达的消息能放进一页；
+    获取数量按预计到达的消息数留出余量，不超过 60。
+    拿到整页新消息说明可能还有没取到的，立即再取一次（时间线设置了 `max_backfill` 时由它补取）。
+    连续没有新消息时间隔按 1.5 倍增长到 max_interval。
+    """
+
+    def __init__(self, timeline, target_latency=10, min_interval=1, max_interval=60,
+                 min_count=10, max_count=60, alpha=0.3, metrics=None, name=None):
+        """
+        :param Timeline timeline: 轮询的时间线
+        :param float target_latency: 有消息时，消息从发出到被获取的平均延迟目标（秒）
+        :param float min_interval: 最短轮询间隔（秒）
+        :param float max_interval: 最长轮询间隔（秒）
+        :param int min_count: 每次最少获取的数量
+        :param int max_count: 每次最多获取的数量，饭否 API 最大为 60
+        :param float alpha: EWMA 中新观测值的权重
+        :param MetricsCollector metrics: 记录轮询决策的指标收集器
+        :param str name: 指标中时间线的名字，默认为 API 名
+        """
+        self.timeline = timeline
+        self.target_latency = target_latency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_count = min_count
+        self.max_count = max_count
+        self.alpha = alpha
+        self.metrics = metrics
+        self.name = name or endpoint_name(timeline.endpoint)
+        self.rate = 0.0  # 估计的到达速度，条/秒
+        self.interval = min_interval
+        self.count = min_count
+        self.polls = 0
+        self.received = 0
+        self._idle = 0  # 连续没有新消息的次数
+        self._last_poll = None
+        self._next_poll = 0
+
+    def poll(self):
+        """获取新消息并调整下一次轮询，返回新消息"""
+        statuses = self.timeline.fetch_newer(count=self.count)
+        self.record(len(statuses))
+        return statuses
+
+    def iter_poll(self):
+        """:meth:`poll` 的流式版本，见 :meth:`Timeline.iter_newer`，整页接收完后才调整下一次轮询"""
+        received = 0
+        for status in self.timeline.iter_newer(count=self.count):
+            received += 1
+            yield status
+        self.record(received)
+
+    @property
+    def next_poll(self):
+        """下一次轮询的时间，以 time.monotonic() 计"""
+        return self._next_poll
+
+    def wait(self):
+        """等到下一次轮询的时间，返回等待的秒数"""
+        delay = max(self._next_poll - time.monotonic(), 0)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def defer(self, seconds):
+        """推迟下一次轮询，例如请求出错之后"""
+        self._next_poll = max(self._next_poll, time.monotonic() + seconds)
+
+    def record(self, received, now=None):
+        """
+        根据一次轮询获取到的新消息数更新估计，决定下一次轮询的时间和数量
+
+        :param int received: 新消息数
+        """
+        now = time.monotonic() if now is None else now
+        # 时间线已经补取过被跳过的消息时不必立即再取
+        full = received >= self.count and not self.timeline.recovered
+        if self._last_poll is not None:
+            elapsed = max(now - self._last_poll, 1e-3)
+            self.rate += self.alpha * (received / elapsed - self.rate)
+        self._last_poll = now
+        self.polls += 1
+        self.received += received
+
+        if full:
+            # 可能还有没取到的消息
+            self._idle = 0
+            interval = self.min_interval
+        elif received:
+            self._idle = 0
+            interval = 2 * self.target_latency
+        else:
+            self._idle += 1
+            interval = self.interval * 1.5 if self._idle > 1 else 2 * self.target_latency
+        if self.rate > 0:
+            # 一个间隔内预计到达的消息不超过一页的 80%
+            interval = min(interval, 0.8 * self.max_count / self.rate)
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+
+        expected = self.rate * self.interval
+        count = self.max_count if full else int(expected * 2) + 1
+        self.count = min(max(count, self.min_count), self.max_count)
+        self._next_poll = now + self.interval
+
+        log.debug('Poller %s: %d new, rate %.3f/s, next poll in %.1fs with count %d',
+                  self.name, received, self.rate, self.interval, self.count)
+        if self.metrics is not None:
+            self.metrics.set_gauge('poll_interval_seconds', self.interval, timeline=self.name)
+            self.metrics.set_gauge('poll_count', self.count, timeline=self.name)
+            self.metrics.set_gauge('arrival_rate', round(self.rate, 4), timeline=self.name)
+            self.metrics.set_gauge('backfill_recovered', self.timeline.recovered_total, timeline=self.name)
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'interval': self.interval,
+            'count': self.count,
+            'polls': self.polls,
+            'received': self.received,
+        }
+
+
+class TimelineMux:
+    """
+    在一个线程里轮询多个时间线，按优先级分配共享的请求额度，新消息通过有界队列交给各自的消费者::
+
+        mux = TimelineMux()
+        mux.add(fan.mentions, reply, priority=0)
+        mux.add(fan.public_timeline, process_status, priority=10)
+        mux.start()
+
+    每个时间线由一个 :class:`AdaptivePoller` 决定轮询时间和数量。到时间的时间线按优先级（数字小的优先）
+    依次向 `budget` 申请令牌，令牌用完时优先级低的等待，补取发出的额外请求也从额度中扣除。
+    消费者的队列放不下一次轮询最多可能返回的消息（包括补取）时暂停轮询该时间线；
+    仍然放不下的消息暂存在该时间线的积压中，调度线程从不阻塞在某个消费者上。
+    每个时间线有一个消费线程，消费者抛出的异常只记录日志。
+    """
+
+    class _Entry:
+        def __init__(self, timeline, consumer, priority, queue_size, poller, name):
+            self.timeline = timeline
+            self.consumer = consumer
+            self.priority = priority
+            self.queue = queue.Queue(queue_size)
+            self.poller = poller
+            self.name = name
+            self.thread = None
+            self.backlog = deque()  # 队列放不下的消息，下次调度时先放入队列
+            self.delivered = 0
+            self.blocked = 0  # 因为队列满而推迟的轮询次数
+            self.failures = 0  # 连续失败的轮询次数
+
+        def backoff(self):
+            """轮询失败后推迟的秒数，连续失败时翻倍，最多 5 分钟"""
+            self.failures += 1
+            return min(3 * 2 ** (self.failures - 1), 300)
+
+        def flush(self):
+            """把积压的消息放入队列，返回是否全部放入"""
+            while self.backlog:
+                try:
+                    self.queue.put_nowait(self.backlog[0])
+                except queue.Full:
+                    return False
+                self.backlog.popleft()
+            return True
+
+        def headroom(self):
+            """一次轮询最多可能返回的消息数，包括补取的页"""
+            need = self.poller.count * (1 + self.timeline.max_backfill)
+            return min(need, self.queue.maxsize)
+
+    def __init__(self, budget=None, tick=0.5, metrics=None):
+        """
+        :param RateLimiter budget: 所有时间线共享的请求额度，默认每小时 1000 次，给其他请求留出余量。
+            不要直接使用 :class:`Fan` 的限流器，否则每次请求会扣两次令牌
+        :param float tick: 没有时间线可以轮询时，调度线程最多等待的秒数
+        :param MetricsCollector metrics: 记录队列长度和各时间线轮询决策的指标收集器
+        """
+        self.budget = budget or RateLimiter(1000 / 3600, burst=10)
+        self.tick = tick
+        self.metrics = metrics
+        self._entries = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, timeline, consumer, priority=0, queue_size=100, name=None, **kwargs):
+        """
+        添加一个时间线
+
+        :param Timeline timeline: 时间线
+        :param consumer: 处理一条新消息的函数，在该时间线的消费线程中调用
+        :param int priority: 优先级，数字小的优先
+        :param int queue_size: 等待消费的消息数上限
+        :param str name: 日志和指标中使用的名字，默认为 API 名加上用户 ID
+        :param kwargs: 传给 :class:`AdaptivePoller` 的参数
+        :return: 该时间线的 :class:`AdaptivePoller`
+        """
+        if name is None:
+            name = endpoint_name(timeline.endpoint)
+            if timeline.user_id:
+                name = '{}:{}'.format(name, timeline.user_id)
+        poller = AdaptivePoller(timeline, metrics=self.metrics, name=name, **kwargs)
+        entry = self._Entry(timeline, consumer, priority, queue_size, poller, name)
+        self._entries.append(entry)
+        if self._thread is not None:
+            self._start_consumer(entry)
+        return poller
+
+    def start(self):
+        """启动调度线程和消费线程"""
+        self._stopped.clear()
+        for entry in self._entries:
+            self._start_consumer(entry)
+        self._thread = threading.Thread(target=self._run, name='mux-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """停止轮询，等消费线程处理完队列中的消息"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        for entry in self._entries:
+            if entry.thread is not None:
+                while entry.backlog:
+                    entry.queue.put(entry.backlog.popleft())
+                entry.queue.put(None)
+                entry.thread.join(timeout)
+                entry.thread = None
+
+    def _start_consumer(self, entry):
+        entry.thread = threading.Thread(target=self._consume, args=(entry,),
+                                        name='mux-' + entry.name, daemon=True)
+        entry.thread.start()
+
+    def _consume(self, entry):
+        while True:
+            status = entry.queue.get()
+            if status is None:
+                return
+            try:
+                entry.consumer(status)
+            except Exception:
+                log.exception('Consumer of %s failed', entry.name)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                wait = self.run_once()
+            except Exception:
+                # 调度线程退出的话所有时间线都会停止，只记录日志
+                log.exception('Timeline scheduling failed')
+                wait = self.tick
+            self._stopped.wait(wait)
+
+    def run_once(self):
+        """
+        进行一次调度：轮询一个到时间的时间线
+
+        :return: 调度线程接下来应该等待的秒数
+        """
+        if not self._entries:
+            return self.tick
+        now = time.monotonic()
+        due = sorted((e for e in self._entries if e.poller.next_poll <= now),
+                     key=lambda e: (e.priority, e.poller.next_poll))
+        for entry in due:
+            if not entry.flush() or entry.queue.maxsize - entry.queue.qsize() < entry.headroom():
+                entry.blocked += 1
+                continue
+            if self.budget.reserve(max_wait=0) is None:
+                break
+            self._poll(entry)
+            return 0
+        if due:
+            return self.tick
+        next_poll = min(e.poller.next_poll for e in self._entries)
+        return min(max(next_poll - now, 0), self.tick)
+
+    def _poll(self, entry):
+        try:
+            statuses = entry.poller.poll()
+        except CircuitOpenError as e:
+            log.warning('Fanfou seems down, delay %s for %.1f seconds', entry.name, e.retry_after)
+            entry.poller.defer(e.retry_after)
+            return
+        except Exception:
+            # 包括响应格式不对等非 FanfouError 的异常，只影响这个时间线
+            delay = entry.backoff()
+            log.exception('Poll %s failed, retry in %d seconds', entry.name, delay)
+            entry.poller.defer(delay)
+            return
+        finally:
+            if entry.timeline.backfill_requests:
+                # 补取的请求在轮询之后补扣，额度透支时之后的轮询等待更久
+                self.budget.reserve(entry.timeline.backfill_requests)
+                entry.timeline.backfill_requests = 0
+        entry.failures = 0
+        entry.backlog.extend(statuses)
+        entry.flush()
+        entry.delivered += len(statuses)
+        if self.metrics is not None:
+            self.metrics.set_gauge('mux_queue_size', entry.queue.qsize(), timeline=entry.name)
+
+    def stats(self):
+        return {entry.name: dict(entry.poller.stats(), priority=entry.priority, queued=entry.queue.qsize(),
+                                 backlog=len(entry.backlog), delivered=entry.delivered, blocked=entry.blocked,
+                                 failures=entry.failures)
+                for entry in self._entries}
+
+
+class TimelineArchiver:
+    """
+    把一条时间线的全部历史消息导出到文件，中断后再次运行时从上次的位置继续。
+
+    从最新的消息开始用 max_id 往前翻页，写入当前一页时后台已经在获取下一页。
+    消息按批写入，每批写完后把翻页位置记录到 :class:`StateJournal`：
+
+    * ``format='jsonl'`` -- 一个 gzip 压缩的 JSON Lines 文件，每批是一个 gzip member，
+      继续时先截掉上次记录之后写了一半的内容
+    * ``format='parquet'`` -- 每批一个 ``path.00000.parquet`` 文件，列见 :attr:`COLUMNS`，需要安装 pyarrow
+    """
+    FORMATS = ('jsonl', 'parquet')
+    COLUMNS = ('id', 'rawid', 'created_at', 'text', 'source', 'user_id', 'user_screen_name',
+               'in_reply_to_status_id', 'in_reply_to_user_id', 'repost_status_id', 'repost_user_id',
+               'photo_url', 'json')
+    """parquet 文件的列，json 列是完整的消息"""
+
+    def __init__(self, timeline, path, format='jsonl', batch_size=600, page_size=60, prefetch=True,
+                 journal=None, journal_key=None, compresslevel=6, metrics=None):
+        """
+        :param Timeline timeline: 要导出的时间线，例如 ``user.statues``，不影响它自己的游标
+        :param str path: 输出文件的路径，parquet 格式时是文件名的前缀
+        :param str format: jsonl 或 parquet
+        :param int batch_size: 每批写入的消息数
+        :param int page_size: 每次获取的数量，最大为60
+        :param bool prefetch: 是否在后台预取下一页
+        :param StateJournal journal: 记录导出位置的状态存储，默认为 ``path + '.state'``
+        :param str journal_key: 导出位置在 journal 中的键，默认为输出路径
+        :param int compresslevel: gzip 压缩级别
+        :param MetricsCollector metrics: 设置后记录导出速度
+        """
+        if format not in self.FORMATS:
+            raise ValueError('format should be one of {}'.format(', '.join(self.FORMATS)))
+        if format == 'parquet' and pyarrow is None:
+            raise ImportError('pyarrow is required to write parquet files')
+        self.timeline = timeline
+        self.path = path
+        self.format = format
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self._own_journal = journal is None
+        self.journal = journal if journal is not None else StateJournal(path + '.state')
+        self.journal_key = journal_key or path
+        self.compresslevel = compresslevel
+        self.metrics = metrics
+        self.archived = 0  # 累计导出的消息数，包括之前的运行
+        self.done = False
+        self._size = 0
+        self._parts = 0
+        self._count = 0  # 本次运行导出的消息数
+        self._started = None
+        self._elapsed = 0.0
+
+    def run(self, limit=None):
+        """
+        开始或继续导出，直到时间线结束，或本次导出了至少 `limit` 条
+
+        :param int limit: 本次最多导出的数量，到达后在一批结束时停止
+        :return: :meth:`stats`
+        :rtype: dict
+        """
+        state = self.journal.get(self.journal_key) or {}
+        self.archived = state.get('archived', 0)
+        self.done = state.get('done', False)
+        self._size = state.get('size', 0)
+        self._parts = state.get('parts', 0)
+        self._count = 0
+        if self.done:
+            log.info('%s is already archived (%d statuses)', self.path, self.archived)
+            return self.stats()
+        if self.format == 'jsonl':
+            self._truncate()
+
+        self._started = time.monotonic()
+        batch = []
+        pages = self._pages(state.get('max_id'), state.get('rawid'))
+        try:
+            for page in pages:
+                batch.extend(page)
+                if len(batch) >= self.batch_size:
+                    self._write(batch)
+                    batch = []
+                    if limit is not None and self._count >= limit:
+                        break
+            else:
+                self._write(batch)
+                self.done = True
+                self._checkpoint(None)
+        finally:
+            pages.close()
+            self._elapsed = time.monotonic() - self._started
+        log.info('Archived %d statuses to %s in %.1f seconds (%.1f statuses/s)%s',
+                 self._count, self.path, self._elapsed, self.throughput, ', done' if self.done else '')
+        return self.stats()
+
+    @property
+    def throughput(self):
+        """本次运行每秒导出的消息数"""
+        if self._started is None:
+            return 0.0
+        elapsed = self._elapsed or time.monotonic() - self._started
+        return self._count / elapsed if elapsed > 0 else 0.0
+
+    def _pages(self, max_id, rawid):
+        """从 max_id 开始往前翻页，产出一页时已经在后台获取下一页"""
+        fetch = functools.partial(self.timeline.fetch, count=self.page_size)
+        executor = None
+        if self.prefetch:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archiver-prefetch')
+        future = None
+        try:
+            while True:
+                page = future.result() if future is not None else fetch(max_id=max_id)
+                if rawid is not None:
+                    # max_id 对应的消息本身也可能被返回
+                    page = [s for s in page if s.rawid < rawid]
+                if not page:
+                    return
+                max_id, rawid = page[-1].id, page[-1].rawid
+                if executor is not None:
+                    future = executor.submit(fetch, max_id=max_id)
+                yield page
+        finally:
+            if future is not None:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _truncate(self):
+        """截掉上次记录的位置之后写了一半的内容"""
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if size < self._size:
+            raise ValueError('{} is shorter than its checkpoint, remove {} to start over'.format(
+                self.path, self.journal_key))
+        if size > self._size:
+            log.warning('Discard %d bytes after the checkpoint of %s', size - self._size, self.path)
+            os.truncate(self.path, self._size)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        if self.format == 'jsonl':
+            data = ''.join(json.dumps(s.to_dict(), ensure_ascii=False) + '\n' for s in batch)
+            with open(self.path, 'ab') as f:
+                f.write(gzip.compress(data.encode('utf-8'), self.compresslevel))
+                f.flush()
+                os.fsync(f.fileno())
+                self._size = f.tell()
+        else:
+            rows = [self._row(s) for s in batch]
+            table = pyarrow.table({col: [row[col] for row in rows] for col in self.COLUMNS},
+                                  schema=self._schema())
+            part = '{}.{:05d}.parquet'.format(self.path, self._parts)
+            pyarrow.parquet.write_table(table, part + '.tmp')
+            os.replace(part + '.tmp', part)
+            self._parts += 1
+        self.archived += len(batch)
+        self._count += len(batch)
+        self._checkpoint(batch[-1])
+
+    def _checkpoint(self, last):
+        state = {'archived': self.archived, 'size': self._size, 'parts': self._parts, 'done': self.done}
+        if last is not None:
+            state.update(max_id=last.id, rawid=last.rawid)
+        else:
+            old = self.journal.get(self.journal_key) or {}
+            state.update(max_id=old.get('max_id'), rawid=old.get('rawid'))
+        self.journal.set(self.journal_key, state)
+        if self.metrics is not None:
+            self.metrics.set_gauge('archive_statuses_per_second', self.throughput, path=self.path)
+            self.metrics.set_gauge('archive_statuses', self.archived, path=self.path)
+
+    def _row(self, status):
+        data = status.to_dict()
+        user = data.get('user') or {}
+        photo = data.get('photo') or {}
+        row = {col: data.get(col) for col in self.COLUMNS}
+        row.update(user_id=user.get('id'), user_screen_name=user.get('screen_name'),
+                   photo_url=photo.get('largeurl') or photo.get('imageurl'),
+                   json=json.dumps(data, ensure_ascii=False))
+        return row
+
+    @classmethod
+    def _schema(cls):
+        return pyarrow.schema([(col, pyarrow.int64() if col == 'rawid' else pyarrow.string())
+                               for col in cls.COLUMNS])
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'archived': self.archived,
+            'this_run': self._count,
+            'statuses_per_second': round(self.throughput, 1),
+            'done': self.done,
+        }
+
+    def close(self):
+        """关闭自己创建的 journal"""
+        if self._own_journal:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class User(Base):
@@ -541,6 +3212,7 @@ class User(Base):
     用户类
     """
     # 需要 id 参数，可查看其他用户信息的 API 在此类中（也可以省略 id 表示当前用户）
+    __slots__ = ('_timeline', '_statues', '_photos', 'mentions', 'replies', '__weakref__')
     endpiont = 'users/show'
     attrs = ('id', 'unique_id', 'name', 'screen_name', 'location', 'gender', 'birthday',
              'description', 'url', 'protected', 'followers_count', 'friends_count', 'favourites_count',
@@ -568,11 +3240,28 @@ class User(Base):
         :param int utc_offset: UTC offset
         """
         super(User, self).__init__(fan, **kwargs)
-        self.created_at = arrow.get(self.dict['created_at'], 'ddd MMM DD HH:mm:ss Z YYYY')
 
-        self.timeline = Timeline(self.fan, self.id, 'statuses/home_timeline')  # 返回此用户看到的时间线
-        self.statues = Timeline(self.fan, self.id, 'statuses/user_timeline')  # 返回此用户已发送的消息
-        self.photos = Timeline(self.fan, self.id, 'photos/user_timeline')  # 浏览指定用户的图片
+    @classmethod
+    def from_json(cls, fan, data):
+        """同一个 :class:`Fan` 中 id 相同的用户共享一个对象，新数据合并到已有对象中"""
+        if not data or not data.get('id'):
+            return super(User, cls).from_json(fan, data)
+        return fan.users.merge(data['id'], data, lambda: super(User, cls).from_json(fan, data))
+
+    @cached_slot
+    def timeline(self):
+        """此用户看到的时间线"""
+        return self.fan.new_timeline(self.id, 'statuses/home_timeline')
+
+    @cached_slot
+    def statues(self):
+        """此用户已发送的消息"""
+        return self.fan.new_timeline(self.id, 'statuses/user_timeline')
+
+    @cached_slot
+    def photos(self):
+        """此用户的图片"""
+        return self.fan.new_timeline(self.id, 'photos/user_timeline')
 
     @property
     def followers(self, count=60):
@@ -582,7 +3271,7 @@ class User(Base):
 
         :param int count: 每次获取的数量
         """
-        for fo in pager(self.fan, 'statuses/followers', id=self.id, count=count):
+        for fo in pager(self.fan, 'statuses/followers', prefetch=WALK_PREFETCH, id=self.id, count=count):
             yield User.from_json(self.fan, fo)
 
     @property
@@ -592,7 +3281,7 @@ class User(Base):
 
         :param int count: 每次获取的数量
         """
-        for fo in pager(self.fan, 'followers/ids', id=self.id, count=count):
+        for fo in pager(self.fan, 'followers/ids', prefetch=WALK_PREFETCH, id=self.id, count=count):
             yield fo
 
     @property
@@ -601,13 +3290,13 @@ class User(Base):
         返回此用户的关注对象
         此用户为当前用户的关注对象或未设置隐私
         """
-        for fr in pager(self.fan, 'statuses/friends', id=self.id, count=count):
+        for fr in pager(self.fan, 'statuses/friends', prefetch=WALK_PREFETCH, id=self.id, count=count):
             yield User.from_json(self.fan, fr)
 
     @property
     def friends_id(self, count=60):
         """返回此用户关注对象的id列表"""
-        for fr in pager(self.fan, 'friends/ids', id=self.id, count=count):
+        for fr in pager(self.fan, 'friends/ids', prefetch=WALK_PREFETCH, id=self.id, count=count):
             yield fr
 
     @property
@@ -740,10 +3429,123 @@ class Photo:
         return self.default_url
 
 
+Entity = namedtuple('Entity', 'type text value')
+"""
+消息中的实体
+
+* mention -- text 为用户名，value 为用户 id
+* topic -- text 和 value 都是话题
+* link -- text 为显示的文字，value 为链接地址
+"""
+
+# 只有以 # 开头的链接才匹配结尾的 #，否则 ``@<a>A</a>#<a>t</a>#`` 中话题开头的 # 会被提及吃掉
+_ANCHOR_RE = re.compile(r'(?:(#)|(@))?<a\b([^>]*)>(.*?)</a>(?(1)(#?))', re.I | re.S)
+_HREF_RE = re.compile(r'\bhref="([^"]*)"', re.I)
+
+
+class StatusText:
+    """
+    单次扫描解析 format=html 的消息内容。
+
+    :attr:`parts` 依次为普通文字（str）和 :class:`Entity`；
+    :attr:`repost_index` 为转发标记（``转@`` 或 ``「@``）后第一个提及在 parts 中的位置，不是转发时为 None。
+    """
+    __slots__ = ('parts', 'repost_index')
+
+    def __init__(self, html):
+        self.parts = parts = []
+        self.repost_index = None
+        pos = 0
+        for match in _ANCHOR_RE.finditer(html):
+            hash_, at, attrs, body, trail = match.groups()
+            lead = hash_ or at or ''
+            start = match.start()
+            if start > pos:
+                parts.append(html[pos:start])
+            pos = match.end()
+            href = _HREF_RE.search(attrs)
+            href = href.group(1) if href else ''
+
+            if lead == '#' and trail:
+                parts.append(Entity('topic', body, body))
+                continue
+            if lead == '@':
+                if self.repost_index is None and start and html[start - 1] in '转「':
+                    self.repost_index = len(parts)
+                parts.append(Entity('mention', body, href.rstrip('/').rsplit('/', 1)[-1]))
+            else:
+                if lead:
+                    parts.append(lead)
+                parts.append(Entity('link', body, href))
+            if trail:
+                parts.append(trail)
+        if pos < len(html):
+            parts.append(html[pos:])
+
+    def render(self, pure=False, stop=None):
+        """
+        输出纯文本
+
+        :param bool pure: 为 True 时去掉提及，话题不带 # 号
+        :param int stop: 只输出 parts[:stop]
+        """
+        out = []
+        for part in self.parts[:stop]:
+            if part.__class__ is str:
+                out.append(part)
+            elif part.type == 'mention':
+                if not pure:
+                    out.append('@' + part.text)
+            elif part.type == 'topic':
+                out.append(part.text if pure else '#' + part.text + '#')
+            else:
+                out.append(part.text)
+        text = ''.join(out)
+        if stop is not None:
+            # 去掉转发标记
+            text = text[:-1]
+        return text.strip()
+
+    @property
+    def text(self):
+        return self.render()
+
+    @property
+    def pure_text(self):
+        return self.render(pure=True)
+
+    @property
+    def repost_comment(self):
+        """转发时附加的评论，不是转发时为 None"""
+        if self.repost_index is None:
+            return None
+        return self.render(pure=True, stop=self.repost_index)
+
+    @property
+    def entities(self):
+        return [part for part in self.parts if part.__class__ is not str]
+
+    def _of_type(self, type):
+        return [part for part in self.parts if part.__class__ is not str and part.type == type]
+
+    @property
+    def mentions(self):
+        return self._of_type('mention')
+
+    @property
+    def topics(self):
+        return self._of_type('topic')
+
+    @property
+    def links(self):
+        return self._of_type('link')
+
+
 class Status(Base):
     """
     消息类
     """
+    __slots__ = ('_user', '_repost_status', '_photo', '_parsed_text', '_repost_comment', '_context')
     endpiont = 'statuses/show'
     attrs = ('id', 'text', 'photo', 'created_at', 'in_reply_to_user_id', 'in_reply_to_status_id',
              'in_reply_to_screen_name', 'repost_status_id', 'repost_status', 'repost_user_id',
@@ -760,37 +3562,37 @@ class Status(Base):
         """
         super().__init__(fan, **kwargs)
 
-        self.user = User.from_json(fan, self.dict['user'])  # type:User
-        self.created_at = arrow.get(self.dict['created_at'], 'ddd MMM DD HH:mm:ss Z YYYY')
+    @cached_slot
+    def user(self):
+        """消息的主人，第一次访问时才创建"""
+        return User.from_json(self.fan, self.dict.get('user'))  # type:User
 
-    @cached_property
+    @cached_slot
     def repost_status(self):
         if 'repost_status' in self.dict:
             return Status.from_json(self.fan, self.dict['repost_status'])
         return None
 
-    @cached_property
+    @cached_slot
     def photo(self):
         if 'photo' in self.dict:
             return Photo(self.dict['photo']['imageurl'])
         return None
 
+    @cached_slot
+    def parsed_text(self):
+        """解析后的消息内容，包含提及、话题、链接等实体"""
+        return StatusText(self.text)
+
+    @property
+    def entities(self):
+        return self.parsed_text.entities
+
     @staticmethod
     def process_text(text, pure=False):
-        at_re = re.compile(r'@<a.*?>(.*?)</a>', re.I)
-        topic_re = re.compile(r'#<a.*?>(.*?)</a>#', re.I)
-        link_re = re.compile(r'<a.*?rel="nofollow" target="_blank">(.*)</a>', re.I)
+        return StatusText(text).render(pure)
 
-        if pure:
-            text = at_re.sub('', text)
-            text = topic_re.sub(r'\1', text)
-        else:
-            text = at_re.sub(r'@\1', text)
-            text = topic_re.sub(r'#\1#', text)
-        text = link_re.sub(r'\1', text)
-        return text.strip()
-
-    @cached_property
+    @cached_slot
     def repost_comment(self):
         """
         User A: @me xxxx -> plain mention
@@ -800,12 +3602,7 @@ class Status(Base):
         # 不是一个转发消息
         if 'repost_status' not in self.dict:
             return None
-        comment_re = re.compile(r'(?P<target>.*?)[转「]@<a')
-        match = comment_re.match(self.text)
-        if match:
-            comment = match.group('target')
-            return self.process_text(comment, True)
-        return None
+        return self.parsed_text.repost_comment
 
     @staticmethod
     def process_photo_link(photo):
@@ -822,7 +3619,7 @@ class Status(Base):
         result = Status.from_json(self.fan, result)
         return result
 
-    @cached_property
+    @cached_slot
     def context(self):
         """按照时间先后顺序显示消息上下文"""
         result = self.fan.get('statuses/context_timeline', id=self.id)
@@ -851,7 +3648,7 @@ class Status(Base):
 
         text = format.format(repost=repost,
                              name=self.user.screen_name,
-                             origin=self.process_text(self.text),
+                             origin=self.parsed_text.text,
                              **kwargs)
         data = dict(status=text,
                     photo=photo,
@@ -875,3 +3672,136 @@ class Status(Base):
         return '<Status ("{}" @{})>'.format(self.text, self.user.id)
 
     __repr__ = __str__
+
+
+SNAPSHOT_MAGIC = b'VAN'
+SNAPSHOT_VERSION = 1
+
+# 快照中的记录类型
+_RECORD_USER_DEF = 0  # 用户资料，加入用户表，不单独产出
+_RECORD_USER = 1  # 用户，数据是用户表中的序号
+_RECORD_STATUS = 2  # 消息，其中的用户替换为用户表中的序号
+
+
+class SnapshotWriter:
+    """
+    把 :class:`User`/:class:`Status` 以紧凑的二进制格式逐条写入文件，用 :class:`SnapshotReader` 读取::
+
+        with open('statuses.bin', 'wb') as f:
+            writer = SnapshotWriter(f)
+            for status in timeline.fetch():
+                writer.write(status)
+
+    文件以 ``SNAPSHOT_MAGIC`` 和一个字节的版本号开头，之后是一串 msgpack 编码的 ``[类型, 数据]`` 记录。
+    同一个用户的资料只写入一次，之后的消息用序号引用，资料有变化时才重新写入。
+
+    :param fp: 以二进制模式打开的文件
+    """
+
+    def __init__(self, fp):
+        if msgpack is None:
+            raise RuntimeError('SnapshotWriter requires msgpack to be installed')
+        self._fp = fp
+        self._packer = msgpack.Packer(use_bin_type=True)
+        self._users = {}  # 用户 id -> (序号, 资料)
+        self._next_index = 0
+        self.count = 0  # 写入的对象数
+        fp.write(SNAPSHOT_MAGIC + bytes((SNAPSHOT_VERSION,)))
+
+    def _intern(self, user):
+        id = user.get('id')
+        entry = self._users.get(id)
+        if entry is not None and entry[1] == user:
+            return entry[0]
+        index = self._next_index
+        self._next_index += 1
+        # 保存副本：copy_json=False 时 IdentityMap 会原地更新同一个 dict，保存引用就比较不出变化
+        self._users[id] = (index, dict(user))
+        self._fp.write(self._packer.pack([_RECORD_USER_DEF, user]))
+        return index
+
+    def _pack_status(self, status):
+        data = dict(status)
+        if data.get('user'):
+            data['user'] = self._intern(data['user'])
+        if data.get('repost_status'):
+            data['repost_status'] = self._pack_status(data['repost_status'])
+        return data
+
+    def write(self, obj):
+        """写入一个 :class:`User` 或 :class:`Status`"""
+        if isinstance(obj, Status):
+            record = [_RECORD_STATUS, self._pack_status(obj.dict)]
+        elif isinstance(obj, User):
+            record = [_RECORD_USER, self._intern(obj.dict)]
+        else:
+            raise TypeError('Cannot serialize {!r}'.format(obj))
+        self._fp.write(self._packer.pack(record))
+        self.count += 1
+
+    def flush(self):
+        self._fp.flush()
+
+
+class SnapshotReader:
+    """
+    逐条读取 :class:`SnapshotWriter` 写入的对象，可以在 for 循环中使用
+
+    :param fan: 读出的对象所属的 :class:`Fan`
+    :param fp: 以二进制模式打开的文件
+    """
+
+    def __init__(self, fan, fp):
+        if msgpack is None:
+            raise RuntimeError('SnapshotReader requires msgpack to be installed')
+        header = fp.read(len(SNAPSHOT_MAGIC) + 1)
+        if len(header) <= len(SNAPSHOT_MAGIC) or header[:-1] != SNAPSHOT_MAGIC:
+            raise ValueError('Not a van snapshot')
+        self.version = header[-1]
+        if self.version > SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version {}'.format(self.version))
+        self.fan = fan
+        self._unpacker = msgpack.Unpacker(fp, raw=False)
+        self._users = []
+
+    def _unpack_status(self, data):
+        if isinstance(data.get('user'), int):
+            data['user'] = self._users[data['user']]
+        if data.get('repost_status'):
+            self._unpack_status(data['repost_status'])
+        return data
+
+    def __iter__(self):
+        for kind, data in self._unpacker:
+            if kind == _RECORD_USER_DEF:
+                self._users.append(data)
+            elif kind == _RECORD_STATUS:
+                yield Status.from_json(self.fan, self._unpack_status(data))
+            elif kind == _RECORD_USER:
+                yield User.from_json(self.fan, self._users[data])
+            else:
+                raise ValueError('Unknown snapshot record type {}'.format(kind))
+
+
+def dumps(objs):
+    """
+    把一组 :class:`User`/:class:`Status` 编码为二进制快照
+
+    :rtype: bytes
+    """
+    fp = io.BytesIO()
+    writer = SnapshotWriter(fp)
+    for obj in objs:
+        writer.write(obj)
+    return fp.getvalue()
+
+
+def loads(fan, data):
+    """
+    解码 :func:`dumps` 生成的快照
+
+    :param fan: 读出的对象所属的 :class:`Fan`
+    :param bytes data: 快照数据
+    :return: :class:`User`/:class:`Status` 数组
+    """
+    return list(SnapshotReader(fan, io.BytesIO(data)))
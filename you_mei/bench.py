@@ -0,0 +1,323 @@
+# van 的性能测试
+#
+# python bench.py           运行全部测试
+# python bench.py json      只运行指定的测试
+#
+# 设置环境变量 VAN_BASELINE 为另一个版本 van.py 的路径，可以同时测试该版本作为对照，例如：
+# git show HEAD~1:you_mei/van.py > /tmp/van_old.py && VAN_BASELINE=/tmp/van_old.py python bench.py memory
+#
+# 测试数据按饭否 API (mode=lite, format=html) 返回的格式生成
+
+import gc
+import importlib.util
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+import van
+
+try:
+    import arrow
+except ImportError:
+    arrow = None
+
+SOURCES = ('<a href="http://fanfou.com/" target="_blank">网页</a>',
+           '<a href="http://m.fanfou.com/" target="_blank">手机上网</a>',
+           '<a href="https://github.com/j178/fanfou-bots" target="_blank">有妹bot</a>')
+WORDS = ('今天', '天气', '不错', '饭否', '吃饭', '睡觉', '上班', '好累', '周末', '电影', '猫', '咖啡', 'hello')
+
+
+def sample_user(i):
+    # 同一个用户的资料每次都相同
+    rnd = random.Random(i)
+    return {
+        'id': f'user{i}',
+        'unique_id': f'~u{i:08d}',
+        'name': f'饭友{i}',
+        'screen_name': f'饭友{i}',
+        'location': '北京 海淀区',
+        'gender': rnd.choice(('男', '女', '')),
+        'birthday': rnd.choice(('', f'{rnd.randint(1970, 2005)}-0{rnd.randint(1, 9)}-1{rnd.randint(0, 9)}')),
+        'description': '这个人很懒，什么都没有留下',
+        'profile_image_url': f'http://s3.meitu.com/avatar/s0/{i}.jpg',
+        'profile_image_url_large': f'http://s3.meitu.com/avatar/l0/{i}.jpg',
+        'url': '',
+        'protected': False,
+        'followers_count': rnd.randint(0, 5000),
+        'friends_count': rnd.randint(0, 2000),
+        'favourites_count': rnd.randint(0, 500),
+        'statuses_count': rnd.randint(0, 50000),
+        'photo_count': rnd.randint(0, 3000),
+        'following': False,
+        'notifications': False,
+        'created_at': 'Sat Jun 09 06:52:36 +0000 2007',
+        'utc_offset': 28800,
+    }
+
+
+def sample_text(i):
+    parts = [random.choice(WORDS) for _ in range(random.randint(3, 20))]
+    kind = i % 5
+    if kind == 1:
+        parts.insert(0, f'@<a href="http://fanfou.com/user{i}" class="former">饭友{i}</a>')
+    elif kind == 2:
+        parts.append('#<a href="/q/%E7%94%B5%E5%BD%B1">电影</a>#')
+    elif kind == 3:
+        parts.append('<a href="http://example.com/a" title="http://example.com/a" rel="nofollow" '
+                     'target="_blank">http://example.com/a</a>')
+    elif kind == 4:
+        parts.append(f'转@<a href="http://fanfou.com/user{i + 1}" class="former">饭友{i + 1}</a> 原消息')
+    return ' '.join(parts)
+
+
+TEXTS = (
+    '转@<a href="http://fanfou.com/wangxing" class="former">王兴</a> 饭否又回来了',
+    '@<a href="http://fanfou.com/youmei" class="former">有妹bot</a> 今天也很可爱 #<a href="/q/%E8%87%AA%E6%8B%8D">自拍</a>#',
+    '好看「@<a href="http://fanfou.com/~abc" class="former">小明</a> 分享图片」',
+    '新文章 <a href="https://example.com/post/1" title="https://example.com/post/1" rel="nofollow" '
+    'target="_blank">https://example.com/post/1</a> 欢迎围观',
+    '#<a href="/q/%E6%97%A9%E5%AE%89">早安</a>##<a href="/q/%E6%89%93%E5%8D%A1">打卡</a># 第 100 天',
+    '纯文字的消息，没有任何链接和提及，只是随便说说。',
+)
+
+
+def sample_status(i, users=1000):
+    rawid = 300000000 + i
+    status = {
+        'created_at': f'Sun Oct 14 10:21:{i % 60:02d} +0000 2018',
+        'id': f'status{rawid}',
+        'rawid': rawid,
+        'text': sample_text(i),
+        'source': random.choice(SOURCES),
+        'truncated': False,
+        'in_reply_to_status_id': '',
+        'in_reply_to_user_id': '',
+        'in_reply_to_screen_name': '',
+        'favorited': False,
+        'is_self': False,
+        'location': '',
+        'user': sample_user(random.randrange(users)),
+    }
+    if i % 3 == 0:
+        status['photo'] = {
+            'imageurl': f'http://photo.fanfou.com/v1/mss_3d/{rawid}.jpg@200w_200h_1l.jpg',
+            'thumburl': f'http://photo.fanfou.com/v1/mss_3d/{rawid}.jpg@120w_120h_1l.jpg',
+            'largeurl': f'http://photo.fanfou.com/v1/mss_3d/{rawid}.jpg@596w_1l.jpg',
+        }
+    return status
+
+
+def sample_timeline(count=60, start=0):
+    return [sample_status(start + i) for i in range(start + count - 1, start - 1, -1)]
+
+
+def report(name, seconds, number, unit='call'):
+    print(f'{name:<24} {seconds / number * 1e6:10.1f} us/{unit}')
+
+
+def versions():
+    """要测试的 van 模块：当前版本，以及 VAN_BASELINE 指定的对照版本"""
+    rv = [('van', van)]
+    path = os.environ.get('VAN_BASELINE')
+    if path:
+        spec = importlib.util.spec_from_file_location('van_baseline', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        rv.insert(0, ('baseline', module))
+    return rv
+
+
+def fake_fan(module, **kwargs):
+    return module.Fan('consumer_key', 'consumer_secret',
+                      {'oauth_token': 'token', 'oauth_token_secret': 'secret'}, **kwargs)
+
+
+def fans():
+    """各版本的 Fan，当前版本额外测试不复制 JSON 的模式"""
+    rv = [(name, module, fake_fan(module)) for name, module in versions()]
+    rv.append(('van copy_json=False', van, fake_fan(van, copy_json=False)))
+    return rv
+
+
+def bench_json(number=200):
+    """解析 60 条消息的时间线：标准库 json 与 orjson/ujson 的对比"""
+    payloads = [json.dumps(sample_timeline(60, i * 60), ensure_ascii=False).encode()
+                for i in range(20)]
+    print(f'payload size: {sum(map(len, payloads)) // len(payloads)} bytes/page')
+
+    decoders = [('json', json.loads)]
+    if van.orjson is not None:
+        decoders.append(('orjson', van.orjson.loads))
+    if van.ujson is not None:
+        decoders.append(('ujson', van.ujson.loads))
+
+    for name, loads in decoders:
+        seconds = timeit.timeit(lambda: [loads(p) for p in payloads], number=number)
+        report(name, seconds, number * len(payloads), 'page')
+
+
+def bench_stream(number=200, chunk_size=8192):
+    """按 8KB 分块接收一页消息：整页解析与 van.iter_json_array 流式解析，后者在第一块到达后即可产出第一条消息"""
+    for count in (60, 600):
+        payload = json.dumps(sample_timeline(count), ensure_ascii=False).encode()
+        chunks = [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)]
+        print(f'{count} statuses, {len(chunks)} chunks')
+
+        seconds = timeit.timeit(lambda: json.loads(b''.join(chunks)), number=number)
+        report('json.loads', seconds, number, 'page')
+        seconds = timeit.timeit(lambda: list(van.iter_json_array(chunks)), number=number)
+        report('iter_json_array', seconds, number, 'page')
+        seconds = timeit.timeit(lambda: next(van.iter_json_array(chunks)), number=number)
+        report('first status', seconds, number, 'page')
+
+        tracemalloc.start()
+        json.loads(b''.join(chunks))
+        _, whole = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in van.iter_json_array(chunks):
+            pass
+        _, stream = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{"peak memory":<24} {whole // 1024:10d} KB json.loads, {stream // 1024} KB iter_json_array')
+
+
+def bench_memory(count=10000):
+    """从解析好的 JSON 构建 1 万条 Status 对象（1000 个不同的用户），每条消息额外占用的内存"""
+    data = [json.loads(json.dumps(s)) for s in sample_timeline(count)]
+    for name, module, fan in fans():
+        gc.collect()
+        tracemalloc.start()
+        statuses = [module.Status.from_json(fan, s) for s in data]
+        size, _ = tracemalloc.get_traced_memory()
+        users = [s.user for s in statuses]
+        with_users, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:<24} {size / len(statuses):10.0f} bytes/status'
+              f' {with_users / len(statuses):10.0f} bytes/status with user')
+        del statuses, users
+
+
+def bench_from_json(number=500):
+    """从一页 60 条消息构建 Status 并按是否带图片筛选，mei 处理公共时间线的典型用法"""
+    page = json.loads(json.dumps(sample_timeline(60)))
+    for name, module, fan in fans():
+        def run():
+            statuses = [module.Status.from_json(fan, s) for s in page]
+            return [s for s in statuses if 'photo' in s.dict]
+
+        report(name, timeit.timeit(run, number=number), number, 'page')
+
+
+def bench_snapshot(number=20):
+    """保存 600 条消息（200 个不同的用户）：JSON 与 van.dumps 二进制快照的大小和速度"""
+    if van.msgpack is None:
+        print('msgpack is not installed')
+        return
+
+    page = [sample_status(i, users=200) for i in range(600)]
+    fan = fake_fan(van)
+    statuses = [van.Status.from_json(fan, s) for s in page]
+    dicts = [s.to_dict() for s in statuses]
+
+    encoders = [
+        ('json indent=2', lambda: json.dumps(dicts, indent=2, ensure_ascii=False).encode(), json.loads),
+        ('json', lambda: json.dumps(dicts, ensure_ascii=False, separators=(',', ':')).encode(), json.loads),
+        ('msgpack', lambda: van.msgpack.packb(dicts, use_bin_type=True),
+         lambda data: van.msgpack.unpackb(data, raw=False)),
+        ('van.dumps', lambda: van.dumps(statuses), lambda data: van.loads(fan, data)),
+    ]
+    for name, dump, load in encoders:
+        data = dump()
+        dump_seconds = timeit.timeit(dump, number=number)
+        load_seconds = timeit.timeit(lambda: load(data), number=number)
+        print(f'{name:<24} {len(data) / len(page):10.0f} bytes/status'
+              f' {dump_seconds / number / len(page) * 1e6:8.2f} us/dump'
+              f' {load_seconds / number / len(page) * 1e6:8.2f} us/load')
+
+
+def bench_walk(total=100000):
+    """用游标遍历 10 万条消息的时间线（API 调用替换为本地生成数据），缓冲区窗口 600 条时的内存峰值"""
+    fan = fake_fan(van)
+    timeline = fan.new_timeline('user0', 'statuses/user_timeline')
+
+    def fetch(since_id=None, max_id=None, count=10):
+        start = int(max_id[len('status'):]) - 300000000 if max_id else total
+        return [van.Status.from_json(fan, sample_status(i)) for i in range(start, max(start - count, 0), -1)]
+
+    timeline.fetch = fetch
+    tracemalloc.start()
+    start = timeit.default_timer()
+    count = sum(1 for _ in timeline)
+    seconds = timeit.default_timer() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timeline.close()
+    print(f'{count} statuses in {seconds:.1f} s, peak memory {peak // 1024} KB, {timeline.buffered} buffered')
+
+
+def bench_created_at(number=200):
+    """解析一页 60 条消息（含用户）的 created_at：arrow 与 van.parse_created_at 的对比"""
+    page = sample_timeline(60)
+    values = [s['created_at'] for s in page] + [s['user']['created_at'] for s in page]
+
+    if arrow is not None:
+        seconds = timeit.timeit(lambda: [arrow.get(v, 'ddd MMM DD HH:mm:ss Z YYYY') for v in values],
+                                number=number)
+        report('arrow', seconds, number, 'page')
+
+    def cold():
+        van.parse_created_at.cache_clear()
+        return [van.parse_created_at(v) for v in values]
+
+    report('parse_created_at', timeit.timeit(cold, number=number), number, 'page')
+    seconds = timeit.timeit(lambda: [van.parse_created_at(v) for v in values], number=number)
+    report('parse_created_at cached', seconds, number, 'page')
+
+
+def bench_text(number=20):
+    """消息文字处理的吞吐量：process_text 各调用一次 pure=True/False，StatusText 解析一次得到全部结果"""
+    corpus = [sample_text(i) for i in range(1000)] + list(TEXTS) * 50
+
+    for name, module in versions():
+        process_text = module.Status.process_text
+
+        def run():
+            for text in corpus:
+                process_text(text, pure=False)
+                process_text(text, pure=True)
+
+        seconds = timeit.timeit(run, number=number)
+        print(f'{name + " process_text":<24} {len(corpus) * number / seconds:10.0f} statuses/s')
+
+    def run():
+        for text in corpus:
+            parsed = van.StatusText(text)
+            parsed.text
+            parsed.pure_text
+            parsed.repost_comment
+
+    seconds = timeit.timeit(run, number=number)
+    print(f'{"StatusText":<24} {len(corpus) * number / seconds:10.0f} statuses/s')
+
+
+BENCHMARKS = {
+    'json': bench_json,
+    'stream': bench_stream,
+    'memory': bench_memory,
+    'from_json': bench_from_json,
+    'snapshot': bench_snapshot,
+    'walk': bench_walk,
+    'created_at': bench_created_at,
+    'text': bench_text,
+}
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    names = sys.argv[1:] or BENCHMARKS
+    for name in names:
+        print(f'== {name}: {BENCHMARKS[name].__doc__}')
+        BENCHMARKS[name]()
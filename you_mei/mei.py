@@ -36,7 +36,8 @@ else:
     config.__dict__.update(config_private.__dict__)
 
 from van import (
-    Fan, Status, FanfouError
+    Fan, Status, FanfouError, CircuitOpenError, ResponseCache, MetricsCollector, AdaptivePoller,
+    SeenFilter
 )
 
 log = logging.getLogger(__name__)
@@ -47,9 +48,16 @@ session = requests.Session()
 session.mount('http://', HTTPAdapter(max_retries=3))
 session.mount('https://', HTTPAdapter(max_retries=3))
 
+WORKERS = 5
+
 fan = Fan(config.FAN_APP_KEY,
           config.FAN_APP_SECRET,
-          config.FAN_ACCESS_TOKEN)
+          config.FAN_ACCESS_TOKEN,
+          cache=ResponseCache(),
+          pool_size=WORKERS + 1,
+          copy_json=False)
+metrics = MetricsCollector()
+fan.use(metrics)
 FaceAttributes = namedtuple('FaceAttributes', 'age gender')
 
 DEBUG = False
@@ -345,13 +353,22 @@ def process_status(status: Status):
 
 def main():
     timeline = fan.public_timeline
-    idle = origin = 5
+    # public_timeline 的 since_id 和 max_id 不管用：不补取（补取依赖 max_id，只会白白多发请求），
+    # 按 id 去重，顺序错乱的消息也不会丢
+    timeline.dedup = SeenFilter(maxsize=5000, bloom_capacity=100000)
+    poller = AdaptivePoller(timeline, target_latency=5, metrics=metrics)
 
-    with ThreadPoolExecutor(max_workers=5,
+    with ThreadPoolExecutor(max_workers=WORKERS,
                             thread_name_prefix='woker') as executor:
         while True:
+            poller.wait()
+            # 整页获取：走 fan.json_loads（orjson 等）比流式解析快，拿到整页后才能批量加载用户资料
             try:
-                statuses = timeline.fetch_newer()
+                statuses = poller.poll()
+            except CircuitOpenError as e:
+                log.warning('Fanfou seems down, wait %.1f seconds', e.retry_after)
+                time.sleep(e.retry_after)
+                continue
             except FanfouError as e:
                 # Fanfou 有可能宕机了
                 log.exception('Fetch new statuses error')
@@ -359,18 +376,14 @@ def main():
                 continue
 
             log.info('Got %s new statuses', len(statuses))
-            if not statuses:
-                idle = min(idle * 1.5, 60)
-            elif len(statuses) <= 3:
-                idle = 10
-            else:
-                idle = origin
 
+            # 批量加载候选消息发布者的资料，过滤时不必逐个请求
+            fan.hydrate([s.user for s in statuses
+                         if 'photo' in s.dict and 'repost_status' not in s.dict],
+                        attrs=('gender', 'birthday'), max_workers=WORKERS)
             for status in statuses:
                 executor.submit(process_status, status)
 
-            time.sleep(idle)
-
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
@@ -380,4 +393,5 @@ if __name__ == '__main__':
         DEBUG_PHOTO_FOLDER.mkdir(parents=True, exist_ok=True)
         DEBUG_STAT_FOLDER.mkdir(parents=True, exist_ok=True)
 
+    metrics.start_logging(600)
     main()